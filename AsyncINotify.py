@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+#
+# asyncio version of INotify. The inotify file descriptor is registered with the event
+# loop, so no threads are needed, and the events are read with async for.
+
+import asyncio
+import pyinotify
+import logging
+import time
+import os
+try:
+    from .INotify import INotify # As a module
+except:
+    from INotify import INotify # From within module
+
+_stopped = object() # Put on the queue by stop to end the iteration
+
+class AsyncINotify:
+    '''
+    Watch directories from an asyncio event loop
+
+    async for (t0, fn) in AsyncINotify(): ...
+
+    With qBatch, each item is instead the list of (t0, fn) from one read of the inotify
+    file descriptor. When more than maxQueue items are waiting, the file descriptor is
+    not read until the consumer catches up, so the kernel holds the events.
+    '''
+    def __init__(self, flags:int=None, qBatch:bool=False, maxQueue:int=0) -> None:
+        '''
+        flags: inotify event mask to watch for, by default the same as INotify's
+        qBatch: yield a list of events per read instead of one event at a time
+        maxQueue: maximum number of items waiting before reading pauses, 0 for unbounded
+        '''
+        self.__wm = pyinotify.WatchManager()
+        self.__notifier = None # Built in start, with the running loop
+        self.__queue = asyncio.Queue()
+        self.__qBatch = qBatch
+        self.__maxQueue = maxQueue
+        self.__batch = []
+        self.__qPaused = False
+        self.__qStopped = False
+        self.__flags = flags if flags is not None else INotify.defaultFlags
+
+    def start(self) -> None:
+        ''' Register with the running event loop, called by the first iteration '''
+        if self.__notifier is not None: return
+        if self.__qStopped: raise RuntimeError("AsyncINotify can not be started after stop")
+        self.__notifier = pyinotify.AsyncioNotifier(self.__wm, asyncio.get_running_loop(),
+                                                    callback=self.__afterRead,
+                                                    default_proc_fun=self.__overflow)
+        logging.info("Registered inotify with the event loop")
+
+    def stop(self) -> None:
+        '''
+        Unregister from the event loop and close the inotify file descriptor, so it can not
+        be started again. Iteration ends after the items already queued.
+        '''
+        if self.__notifier is None: return
+        self.__notifier.stop()
+        self.__notifier = None
+        self.__qPaused = False
+        self.__qStopped = True
+        self.__queue.put_nowait(_stopped)
+
+    async def __aenter__(self) -> "AsyncINotify":
+        self.start()
+        return self
+
+    async def __aexit__(self, excType, excValue, excTraceback) -> None:
+        self.stop()
+
+    def addTree(self, tgt:str) -> None:
+        self.addWatch(tgt, qRecursive=True, qAutoAdd=True)
+
+    def addWatch(self, tgt:str, mask:int=None, qRecursive:bool=False, qAutoAdd:bool=False) -> bool:
+        tgt = os.path.abspath(os.path.expanduser(tgt))
+        if os.path.isdir(tgt):
+            mask = mask if mask is not None else self.__flags
+            self.__wm.add_watch(path=tgt, mask=mask, proc_fun=self.__eventHandler,
+                    rec=qRecursive, auto_add=qAutoAdd)
+            logging.info("Added watch for %s, rec %s auto %s", tgt, qRecursive, qAutoAdd)
+            return True
+        logging.error("Path %s does not exist", tgt)
+        return False
+
+    def __aiter__(self) -> "AsyncINotify":
+        self.start()
+        return self
+
+    async def __anext__(self):
+        if self.__notifier is None and self.__queue.empty(): raise StopAsyncIteration
+        item = await self.__queue.get()
+        if item is _stopped: raise StopAsyncIteration
+        if self.__qPaused and self.__queue.qsize() < self.__maxQueue:
+            self.__qPaused = False
+            self.__notifier.loop.add_reader(self.__wm.get_fd(), self.__notifier.handle_read)
+        return item
+
+    def __afterRead(self, notifier:pyinotify.Notifier) -> None:
+        if self.__qBatch and self.__batch:
+            self.__queue.put_nowait(self.__batch)
+            self.__batch = []
+        if self.__maxQueue and self.__queue.qsize() >= self.__maxQueue:
+            self.__qPaused = True # The kernel holds events until the consumer catches up
+            notifier.loop.remove_reader(self.__wm.get_fd())
+
+    def __overflow(self, e:pyinotify.Event) -> None:
+        ''' Events without a watch, IN_Q_OVERFLOW means events were lost '''
+        if e.mask & pyinotify.IN_Q_OVERFLOW:
+            logging.warning("inotify queue overflowed, events were lost")
+
+    def __eventHandler(self, e:pyinotify.Event) -> None:
+        t0 = time.time() # Time of the event
+        fn = e.path if e.dir else os.path.join(e.path, e.name)
+        if self.__qBatch:
+            self.__batch.append((t0, fn))
+        else:
+            self.__queue.put_nowait((t0, fn))
+        logging.debug("Event %s, %s", fn, e.maskname)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import Logger
+
+    parser = ArgumentParser()
+    Logger.addArgs(parser)
+    parser.add_argument("--batch", action="store_true", help="Get a list of events per read")
+    parser.add_argument("--maxQueue", type=int, default=0,
+            help="Stop reading when this many items are waiting")
+    parser.add_argument("tgt", nargs="+", help="Directories to watch")
+    args = parser.parse_args()
+
+    Logger.mkLogger(args, qThreaded=False)
+
+    async def main(args:ArgumentParser) -> None:
+        i = AsyncINotify(qBatch=args.batch, maxQueue=args.maxQueue)
+        for tgt in args.tgt: i.addTree(tgt)
+        async for item in i:
+            logging.info("%s", item)
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
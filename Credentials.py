@@ -3,9 +3,9 @@
 #
 import os
 import logging
-import yaml
 
 def getCredentials(fn:str) -> str:
+    import yaml # Only needed here, so importing this module is quick
     fn = os.path.abspath(os.path.expanduser(fn))
     if os.path.isfile(fn):
         try:
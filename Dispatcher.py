@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+#
+# Take events from an INotify queue and run a callback for each of them on a pool of
+# threads or processes. The events for a path are run in order, one at a time, while
+# different paths run in parallel. Exceptions go to Thread.waitForException.
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+import threading
+import logging
+import queue
+try:
+    from .Thread import Thread # As a module
+except:
+    from Thread import Thread # From within module
+
+class Dispatcher(Thread):
+    '''
+    Run callback(item) for each item from q, an INotify queue, (t0, fn) or Coalesced,
+    or a BatchQueue of lists of them. Items with the same fn are run in the order
+    they arrived and never concurrently, items for different fns run in parallel.
+    Once maxPending items are running or waiting, taking items from q blocks until some
+    finish, so a bounded q fills up instead of memory. After stop, it takes no more items
+    from q, finishes the ones it has, and runIt returns.
+    '''
+    stopCheck = 0.5 # Seconds between checks for stop while waiting for items
+    def __init__(self, args:ArgumentParser, q:queue.Queue, callback, workers:int=None,
+                 qProcesses:bool=False, maxPending:int=1000, name:str="Dispatcher") -> None:
+        '''
+        q: queue to take the items from
+        callback: function called with each item, it must be picklable with qProcesses
+        workers: pool size, by default the executor's default
+        qProcesses: use a process pool, for CPU bound callbacks, instead of threads
+        maxPending: maximum number of items running or waiting, None for unbounded
+        '''
+        Thread.__init__(self, name, args)
+        self.__queue = q
+        self.__callback = callback
+        self.__workers = workers
+        self.__qProcesses = qProcesses
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock) # Notified when nothing is waiting
+        self.__waiting = {} # fn -> deque of items behind the one running
+        self.__pending = None if maxPending is None else threading.Semaphore(maxPending)
+        self.__pool = None
+
+    def runIt(self) -> None: # Called on thread start
+        if self.__qProcesses: # Only load multiprocessing when used
+            from concurrent.futures import ProcessPoolExecutor as Executor
+        else:
+            Executor = ThreadPoolExecutor
+        with Executor(max_workers=self.__workers) as pool:
+            self.__pool = pool
+            q = self.__queue
+            while not self.stopping():
+                try:
+                    items = q.get(timeout=self.stopCheck)
+                except queue.Empty:
+                    continue
+                self.mark()
+                for item in (items if isinstance(items, list) else (items,)):
+                    if self.__pending is not None: self.__pending.acquire() # Backpressure
+                    self.__dispatch(item)
+                q.task_done()
+            with self.__idle: # Before the pool shuts down, which refuses new submissions
+                while self.__waiting: self.__idle.wait()
+
+    def __dispatch(self, item:tuple) -> None:
+        fn = item[1]
+        with self.__lock:
+            if fn in self.__waiting: # Running, so wait for it to finish
+                self.__waiting[fn].append(item)
+                return
+            self.__waiting[fn] = deque()
+        self.__submit(fn, item)
+
+    def __submit(self, fn:str, item:tuple) -> None:
+        try:
+            future = self.__pool.submit(self.__callback, item)
+        except Exception as e: # e.g. BrokenProcessPool, item and those behind it are lost
+            with self.__lock:
+                n = 1 + len(self.__waiting.pop(fn, ()))
+                if not self.__waiting: self.__idle.notify_all()
+            if self.__pending is not None: self.__pending.release(n)
+            logging.error("Unable to submit %s items for %s, %s", n, fn, e)
+            self.putException(e)
+            return
+        future.add_done_callback(lambda f: self.__done(fn, f))
+
+    def __done(self, fn:str, future:Future) -> None:
+        ''' Called when the item for fn finishes, starts the next one for fn if any '''
+        e = future.exception()
+        if e is not None:
+            logging.error("Callback for %s failed, %s", fn, e)
+            self.putException(e)
+        if self.__pending is not None: self.__pending.release()
+        with self.__lock:
+            waiting = self.__waiting[fn]
+            if not waiting:
+                del self.__waiting[fn]
+                if not self.__waiting: self.__idle.notify_all()
+                return
+            item = waiting.popleft()
+        self.__submit(fn, item)
+
+    def qsize(self) -> int:
+        ''' Number of paths running or waiting '''
+        with self.__lock: return len(self.__waiting)
+
+if __name__ == "__main__":
+    import Logger
+    import time
+    from INotify import INotify
+
+    def process(item:tuple) -> None:
+        logging.info("Processing %s", item)
+        time.sleep(1) # Something slow
+        logging.info("Done with %s", item[1])
+
+    parser = ArgumentParser()
+    Logger.addArgs(parser)
+    parser.add_argument("--workers", type=int, help="Number of workers")
+    parser.add_argument("--processes", action="store_true", help="Use processes, not threads")
+    parser.add_argument("--maxPending", type=int, default=1000,
+                        help="Maximum items running or waiting to run")
+    parser.add_argument("tgt", nargs="+", help="Directories to watch")
+    args = parser.parse_args()
+
+    Logger.mkLogger(args)
+
+    i = INotify(args)
+    dispatcher = Dispatcher(args, i.queue, process, args.workers, args.processes,
+                            args.maxPending)
+    i.start()
+    dispatcher.start()
+    for tgt in args.tgt: i.addTree(tgt)
+
+    try:
+        Thread.waitForException()
+    except:
+        logging.exception("Exception from INotify")
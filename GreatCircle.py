@@ -8,6 +8,9 @@
 
 import numpy as np
 from enum import Enum
+from functools import lru_cache, partial
+import logging
+import os
 
 class Units(float, Enum):
     Meters = 1.
@@ -15,77 +18,759 @@ class Units(float, Enum):
     Miles = Meters / 1609.34
     NauticalMiles = Meters / 1852
 
+class Method(str, Enum):
+    Vincenty = "vincenty"   # Iterative, sub-millimeter
+    Thomas = "thomas"       # Closed form, second order in flattening
+    Andoyer = "andoyer"     # Closed form, Andoyer-Lambert first order in flattening
+    Haversine = "haversine" # Closed form, sphere with the mean radius
+    Auto = "auto"           # Cheapest method meeting a tolerance
+
+rMajor = 6378137           # WGS-84 semi-major axis in meters
+flattening = 1/298.257223563 # WGS-84 flattening of the ellipsoid
+rMinor = (1 - flattening) * rMajor # WGS-84 semi-minor axis in meters
+rMean = (2 * rMajor + rMinor) / 3 # Mean radius of the ellipsoid in meters
+
+# Maximum error in meters of each closed form method, from least to most expensive,
+# for distances up to closedFormLimit, measured against Vincenty's method for
+# distance.sample.nc and 2e5 random pairs. Beyond closedFormLimit, nearly antipodal
+# points, the errors grow to ~6 km for Thomas and ~4 km for Andoyer.
+closedFormLimit = 15e6 # meters
+methodErrors = {
+        Method.Haversine: 40000,
+        Method.Andoyer: 100,
+        Method.Thomas: 0.5,
+        }
+
+parallelMinimum = 1000000 # Fewer pairs than this are not worth starting worker processes
+
+def _reducedLatitude(lat:np.array, sinU:np.array=None, cosU:np.array=None) -> tuple:
+    ''' Sine and cosine of the reduced latitude for lat in degrees, in place if given '''
+    sinU = np.deg2rad(lat, out=sinU)
+    np.tan(sinU, out=sinU)
+    sinU *= 1 - flattening # Tangent of reduced latitude
+    cosU = np.multiply(sinU, sinU, out=cosU)
+    cosU += 1
+    np.sqrt(cosU, out=cosU)
+    np.reciprocal(cosU, out=cosU) # trig ident from 1 = sin^2+cos^2, up to +-
+    sinU *= cosU # Sine of reduced latitude
+    return (sinU, cosU)
+
+def _ellipsoidTerms(sinSigma:np.array, cosSigma:np.array, cos2Sigma:np.array,
+                    cosAlpha2:np.array) -> tuple:
+    ''' Vincenty's A and deltaSigma terms '''
+    u2 = cosAlpha2 * (rMajor**2 - rMinor**2) / rMinor**2
+    A = 1 + u2/16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2/1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    deltaSigma = B * sinSigma * (
+            cos2Sigma + 
+            B / 4 * (
+                cosSigma * (-1 + 2 * cos2Sigma**2) - 
+                B/6 * cos2Sigma * (-3 + 4 * sinSigma**2) * (-3 + 4 * cos2Sigma**2))
+             )
+    return (A, deltaSigma)
+
+# Half the meridional perimeter, the longest geodesic on the ellipsoid, (cos^2 alpha = 1, sigma = pi)
+halfMeridian = rMinor * _ellipsoidTerms(0., -1., -1., 1.)[0] * np.pi
+
+def _antipodal(sinU1:np.array, cosU1:np.array, sinU2:np.array, cosU2:np.array,
+               dLon:np.array) -> np.array:
+    '''
+    Lambert's closed form distance in meters, used for pairs where Vincenty's iteration
+    does not converge, i.e. nearly antipodal points. It is clipped to the half meridian.
+    '''
+    cosSigma = np.clip(sinU1 * sinU2 + cosU1 * cosU2 * np.cos(dLon), -1, 1)
+    sigma = np.arccos(cosSigma) # Central angle on the auxiliary sphere
+    sinSigma = np.sin(sigma)
+    beta1 = np.arctan2(sinU1, cosU1)
+    beta2 = np.arctan2(sinU2, cosU2)
+    sinP2 = np.sin((beta1 + beta2) / 2)**2
+    sinQ2 = np.sin((beta2 - beta1) / 2)**2
+    cosHalf2 = (1 + cosSigma) / 2 # cos^2(sigma/2)
+    sinHalf2 = (1 - cosSigma) / 2 # sin^2(sigma/2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        X = np.where(cosHalf2 > 0, (sigma - sinSigma) * sinP2 * (1 - sinQ2) / cosHalf2, 0)
+        Y = np.where(sinHalf2 > 0, (sigma + sinSigma) * (1 - sinP2) * sinQ2 / sinHalf2, 0)
+    return np.minimum(rMajor * (sigma - flattening / 2 * (X + Y)), halfMeridian)
+
+class _Workspace:
+    '''
+    Scratch buffers for one chunk of pairs, allocated once and reused for every chunk.
+    The reduced latitude terms are built in place so no full length temporaries are made.
+    '''
+    def __init__(self, n:int, dtype:np.dtype=float) -> None:
+        self.size = n
+        self.sinU1 = np.empty(n, dtype=dtype)
+        self.cosU1 = np.empty(n, dtype=dtype)
+        self.sinU2 = np.empty(n, dtype=dtype)
+        self.cosU2 = np.empty(n, dtype=dtype)
+        self.dLon = np.empty(n, dtype=dtype)
+        self.sigma = np.empty(n, dtype=dtype) # Final values per pair from Vincenty's iteration
+        self.sinSigma = np.empty(n, dtype=dtype)
+        self.cosSigma = np.empty(n, dtype=dtype)
+        self.cos2Sigma = np.empty(n, dtype=dtype)
+        self.cosAlpha2 = np.empty(n, dtype=dtype)
+        self.converged = np.empty(n, dtype=bool)
+        self.iterations = np.empty(n, dtype=int)
+
+    def view(self, n:int) -> "_Workspace":
+        ''' A workspace sharing these buffers for a shorter, final, chunk '''
+        if n == self.size: return self
+        work = _Workspace.__new__(_Workspace)
+        for key, val in self.__dict__.items():
+            setattr(work, key, val[:n] if isinstance(val, np.ndarray) else n)
+        return work
+
+    def __wrapLongitude(self) -> None:
+        dLon = self.dLon
+        np.deg2rad(dLon, out=dLon)
+        dLon += np.pi # Wrap into [-pi, pi)
+        np.remainder(dLon, 2 * np.pi, out=dLon)
+        dLon -= np.pi
+
+    def load(self, lon1:np.array, lat1:np.array, lon2:np.array, lat2:np.array) -> None:
+        ''' Fill in the reduced latitude terms and longitude differences from degrees '''
+        _reducedLatitude(lat1, self.sinU1, self.cosU1)
+        _reducedLatitude(lat2, self.sinU2, self.cosU2)
+        np.subtract(lon2, lon1, out=self.dLon)
+        self.__wrapLongitude()
+
+    def loadPairs(self, side1:"_Side", side2:"_Side", i0:int, i1:int) -> tuple:
+        '''
+        Fill in every pair of rows i0:i1 of side1 with all of side2 from the cached
+        reduced latitude terms. Returns the (rows, columns) shape of the block.
+        '''
+        shape = (i1 - i0, side2.lon.size)
+        np.copyto(self.sinU1.reshape(shape), side1.sinU[i0:i1, None])
+        np.copyto(self.cosU1.reshape(shape), side1.cosU[i0:i1, None])
+        np.copyto(self.sinU2.reshape(shape), side2.sinU[None, :])
+        np.copyto(self.cosU2.reshape(shape), side2.cosU[None, :])
+        np.subtract(side2.lon[None, :], side1.lon[i0:i1, None], out=self.dLon.reshape(shape))
+        self.__wrapLongitude()
+        return shape
+
+    def loadTrack(self, side:"_Side", i0:int, i1:int) -> None:
+        ''' Fill in the segments from point i to i+1 for i in i0:i1 of side '''
+        np.copyto(self.sinU1, side.sinU[i0:i1])
+        np.copyto(self.cosU1, side.cosU[i0:i1])
+        np.copyto(self.sinU2, side.sinU[i0+1:i1+1])
+        np.copyto(self.cosU2, side.cosU[i0+1:i1+1])
+        np.subtract(side.lon[i0+1:i1+1], side.lon[i0:i1], out=self.dLon)
+        self.__wrapLongitude()
+
+class _Side:
+    ''' One side of a set of pairs with its reduced latitude terms computed once '''
+    def __init__(self, lon:np.array, lat:np.array) -> None:
+        (lon, lat) = np.broadcast_arrays(np.asarray(lon, dtype=float),
+                                         np.asarray(lat, dtype=float))
+        self.lon = lon.reshape(-1)
+        self.lat = lat.reshape(-1)
+        (self.sinU, self.cosU) = _reducedLatitude(self.lat)
+
 def greatCircle(lon1:np.array, lat1:np.array, lon2:np.array, lat2:np.array, 
-                units:Units=Units.Meters, criteria:float=1e-12):
-    ''' Radius of earth in meters using Vicenty's inverse method '''
+                units:Units=Units.Meters, criteria:float=1e-12, maxIterations:int=200,
+                qDiagnostics:bool=False, out:np.array=None, chunkSize:int=None,
+                method:Method=Method.Vincenty, tolerance:float=None, workers:int=None,
+                dtype:np.dtype=None):
+    '''
+    Distance on the WGS-84 ellipsoid using Vicenty's inverse method
 
-    if isinstance(lon1, float): lon1 = np.array([lon1])
-    if isinstance(lat1, float): lat1 = np.array([lat1])
-    if isinstance(lon2, float): lon2 = np.array([lon2])
-    if isinstance(lat2, float): lat2 = np.array([lat2])
+    Each pair iterates until its own lambda change is below criteria, or maxIterations
+    is reached. Pairs which drop out are not recomputed. Pairs which do not converge,
+    nearly antipodal points, use Lambert's closed form instead, good to a few km,
+    and a warning is logged.
 
-    rMajor = 6378137          # WGS-84 semi-major axis in meters
-    f = 1/298.257223563       # WGS-84 flattening of the ellipsoid
-    rMinor = (1 - f) * rMajor # WGS-84 semi-minor axis in meters
+    qDiagnostics: if True return (distance, converged, iterations) where converged is
+                  False for pairs which used the antipodal fallback
+    out: array to store the distances in, e.g. an np.memmap, it is also returned
+    chunkSize: number of pairs to work on at a time, so the scratch memory is bounded
+               independent of the input length. By default all pairs are done at once.
+    method: Vincenty, or one of the closed form methods, Thomas, Andoyer, or Haversine,
+            see methodErrors for their error bounds. Auto picks the cheapest method
+            whose error bound is within tolerance, which is in units, and uses Vincenty
+            for pairs further apart than closedFormLimit.
+    workers: number of processes to split the pairs over, 0 for one per CPU. Inputs with
+             fewer than parallelMinimum pairs are done serially.
+    dtype: floating point type to compute and return the distances in, by default the
+           inputs' floating point type, at least float32, and float64 for other inputs.
+           np.float32 halves the scratch memory, good to about 10 m with Vincenty,
+           and criteria is raised to what float32 can resolve.
 
-    # Avoid a division problem with the points are the same
-    qSame = np.logical_and(lat1 == lat2, lon1 == lon2)
-    qDiff = np.logical_not(qSame)
+    pandas Series return a Series with the same index, which all the Series must share,
+    see Series.align. xarray DataArrays return a
+    DataArray with the same coordinates, and dask backed ones, e.g. from
+    xr.open_dataset(fn, chunks=...), are computed lazily chunk by chunk, as are dask arrays.
+    Floating point inputs are not copied, they are cast a chunk at a time.
+    '''
+    dtype = _resultDtype((lon1, lat1, lon2, lat2), dtype)
+    kind = _containerKind((lon1, lat1, lon2, lat2))
+    if kind is not None:
+        return _containers[kind]((lon1, lat1, lon2, lat2), out, dict(
+            units=units, criteria=criteria, maxIterations=maxIterations,
+            qDiagnostics=qDiagnostics, chunkSize=chunkSize, method=method,
+            tolerance=tolerance, workers=workers, dtype=dtype))
 
-    lon1 = np.deg2rad(lon1[qDiff]) # Convert from decimal degrees to radians
-    lat1 = np.deg2rad(lat1[qDiff])
-    lon2 = np.deg2rad(lon2[qDiff])
-    lat2 = np.deg2rad(lat2[qDiff])
+    qAuto = Method(method) == Method.Auto
+    method = _pickMethod(method, tolerance, units)
+    criteria = max(criteria, 8 * np.finfo(dtype).eps) # Resolvable change in lambda
 
-    tanU1 = (1 - f) * np.tan(lat1) # Tangent of reduced latitude
-    tanU2 = (1 - f) * np.tan(lat2)
-    cosU1 = 1 / np.sqrt(1 + tanU1**2) # trig ident from 1 = sin^2+cos^2, up to +-
-    cosU2 = 1 / np.sqrt(1 + tanU2**2)
-    sinU1 = tanU1 * cosU1 # Sine of reduced latitude
-    sinU2 = tanU2 * cosU2
+    lon1 = _asFloat(lon1) # Scalars, lists, Series, memmaps, ...
+    lat1 = _asFloat(lat1)
+    lon2 = _asFloat(lon2)
+    lat2 = _asFloat(lat2)
+    (lon1, lat1, lon2, lat2) = np.broadcast_arrays(lon1, lat1, lon2, lat2)
+    shape = lon1.shape if lon1.ndim else (1,)
 
-    dLon = lon2 - lon1 # difference of longitudes
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"out shape {out.shape} does not match the input shape {shape}")
+    elif out.ndim > 1 and not out.flags.c_contiguous:
+        raise ValueError("out must be C contiguous")
 
+    (lon1, lat1, lon2, lat2, dist) = map(lambda x: x.reshape(-1),
+                                         (lon1, lat1, lon2, lat2, out))
+    n = dist.size
+    chunkSize = max(1, n if chunkSize is None else min(int(chunkSize), n))
+
+    if qDiagnostics:
+        qConverged = np.empty(n, dtype=bool)
+        nIterations = np.empty(n, dtype=int)
+    else:
+        (qConverged, nIterations) = (None, None)
+
+    options = dict(units=float(units), method=method, qAuto=qAuto, criteria=criteria,
+                   maxIterations=maxIterations, chunkSize=chunkSize, dtype=dtype.str)
+
+    workers = os.cpu_count() if workers == 0 else workers
+    if workers is not None and workers > 1 and n >= parallelMinimum:
+        nFallback = _greatCircleParallel((lon1, lat1, lon2, lat2, dist, qConverged, nIterations),
+                                         workers, options)
+    else:
+        nFallback = _greatCircleFlat(lon1, lat1, lon2, lat2, dist, qConverged, nIterations,
+                                     **options)
+
+    if nFallback:
+        logging.warning("%s of %s pairs did not converge, using antipodal approximation",
+                        nFallback, n)
+
+    if not qDiagnostics: return out
+    return (out, qConverged.reshape(shape), nIterations.reshape(shape))
+
+def _asFloat(x) -> np.array:
+    ''' x as an array, floating point arrays are not copied '''
+    x = np.asarray(x)
+    return x if x.dtype.kind == "f" else x.astype(float)
+
+def _resultDtype(args:tuple, dtype:np.dtype) -> np.dtype:
+    ''' dtype, or by default the floating point type of args, at least float32 '''
+    if dtype is not None: return np.dtype(dtype)
+    dtypes = [getattr(x, "dtype", None) for x in args] # Arrays, Series, DataArrays, numpy scalars
+    dtypes = [x if isinstance(x, np.dtype) and x.kind == "f" else np.dtype(float) for x in dtypes]
+    return np.promote_types(np.result_type(*dtypes), np.float32)
+
+def _containerKind(args:tuple) -> str:
+    ''' "xarray", "dask", "pandas", or None, by module so none of them are imported '''
+    kinds = {type(x).__module__.split(".")[0] for x in args}
+    for kind in _containers:
+        if kind in kinds: return kind
+    return None
+
+def _greatCircleXarray(args:tuple, out:np.array, kwargs:dict):
+    ''' greatCircle on DataArrays, lazily for each dask chunk '''
+    import xarray as xr
+    if out is not None: raise ValueError("out is not supported for xarray inputs")
+    dtypes = [kwargs["dtype"], bool, int]
+    nOut = 3 if kwargs["qDiagnostics"] else 1
+    return xr.apply_ufunc(_greatCircleBlock, *args, kwargs=kwargs,
+                          output_core_dims=[[]] * nOut, output_dtypes=dtypes[:nOut],
+                          dask="parallelized")
+
+def _greatCircleDask(args:tuple, out:np.array, kwargs:dict):
+    ''' greatCircle on dask arrays, lazily for each chunk '''
+    import dask.array as da
+    if out is not None: raise ValueError("out is not supported for dask inputs")
+    if kwargs["qDiagnostics"]: raise ValueError("qDiagnostics is not supported for dask inputs")
+    return da.map_blocks(partial(_greatCircleBlock, **kwargs), *da.broadcast_arrays(*args),
+                         dtype=kwargs["dtype"])
+
+def _greatCircleBlock(*args, **kwargs):
+    ''' greatCircle on one block of arrays, keeping 0-d shapes '''
+    shape = np.broadcast(*args).shape
+    result = greatCircle(*args, **kwargs)
+    if kwargs["qDiagnostics"]: return tuple(x.reshape(shape) for x in result)
+    return result.reshape(shape)
+
+def _greatCircleSeries(args:tuple, out:np.array, kwargs:dict):
+    '''
+    greatCircle on pandas Series, returning Series with their index. Other pandas
+    inputs, e.g. an Index, without any Series give ndarrays, as for numpy inputs.
+    Series are combined by position, so their indexes must be the same.
+    '''
+    import pandas as pd
+    indices = [x.index for x in args if isinstance(x, pd.Series)]
+    index = indices[0] if indices else None
+    if any(not index.equals(x) for x in indices[1:]):
+        raise ValueError("Series indexes differ, align them first, e.g. with Series.align")
+    args = [x.to_numpy() if isinstance(x, (pd.Series, pd.Index)) else x for x in args] # No copies
+    result = greatCircle(*args, out=out, **kwargs)
+    if index is None: return result
+    if kwargs["qDiagnostics"]: return tuple(pd.Series(x, index=index) for x in result)
+    return pd.Series(result, index=index)
+
+_containers = { # In order of precedence, DataArrays may hold dask arrays
+        "xarray": _greatCircleXarray,
+        "dask": _greatCircleDask,
+        "pandas": _greatCircleSeries,
+        }
+
+def _greatCircleFlat(lon1:np.array, lat1:np.array, lon2:np.array, lat2:np.array,
+                     dist:np.array, qConverged:np.array, nIterations:np.array,
+                     units:float, method:Method, qAuto:bool, criteria:float,
+                     maxIterations:int, chunkSize:int, dtype:str="f8") -> int:
+    '''
+    greatCircle on 1-D arrays, chunkSize pairs at a time, storing into dist, and
+    qConverged and nIterations if not None. Returns the number of pairs not converged.
+    The inputs are cast to dtype a chunk at a time as they are loaded into the workspace.
+    '''
+    n = dist.size
+    chunkSize = max(1, min(chunkSize, n))
+    work = _Workspace(chunkSize, dtype)
+    nFallback = 0
+    for i0 in range(0, n, chunkSize):
+        i1 = min(i0 + chunkSize, n)
+        w = work.view(i1 - i0)
+        w.load(lon1[i0:i1], lat1[i0:i1], lon2[i0:i1], lat2[i0:i1])
+        if method == Method.Vincenty:
+            nFallback += _vincenty(w, dist[i0:i1], criteria, maxIterations)
+        else:
+            _closedForms[method](w, dist[i0:i1])
+            w.converged[:] = True
+            w.iterations[:] = 0
+            if qAuto: nFallback += _vincentyFar(w, dist[i0:i1], criteria, maxIterations)
+        # Avoid a division problem with the points are the same
+        qSame = np.logical_and(lat1[i0:i1] == lat2[i0:i1], lon1[i0:i1] == lon2[i0:i1])
+        dist[i0:i1][qSame] = 0
+        if units != Units.Meters: dist[i0:i1] *= units
+        if qConverged is not None:
+            w.converged[qSame] = True
+            w.iterations[qSame] = 0
+            qConverged[i0:i1] = w.converged
+            nIterations[i0:i1] = w.iterations
+    return nFallback
+
+def _attach(specs:tuple) -> tuple:
+    ''' Attach to the shared memory blocks in specs, (name, dtype, size) or None '''
+    from multiprocessing import shared_memory
+    blocks = []
+    arrays = []
+    for spec in specs:
+        if spec is None:
+            arrays.append(None)
+            continue
+        (name, dtype, n) = spec
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays.append(np.ndarray((n,), dtype=dtype, buffer=shm.buf))
+    return (blocks, arrays)
+
+def _parallelWorker(specs:tuple, i0:int, i1:int, options:dict) -> int:
+    ''' Run greatCircle on pairs i0:i1 of the shared arrays, in a worker process '''
+    (blocks, arrays) = _attach(specs)
+    try:
+        return _greatCircleFlat(*[None if a is None else a[i0:i1] for a in arrays], **options)
+    finally:
+        del arrays
+        for shm in blocks: shm.close()
+
+def _greatCircleParallel(arrays:tuple, workers:int, options:dict) -> int:
+    '''
+    Split the pairs into one slice per worker. The inputs are copied once into shared
+    memory, each worker process writes directly into a shared output, so nothing but
+    the block names is pickled. The outputs are copied back into arrays.
+    '''
+    from multiprocessing import shared_memory # Only loaded when used
+    from concurrent.futures import ProcessPoolExecutor
+    n = arrays[4].size
+    blocks = []
+    specs = []
+    shared = []
+    try:
+        for a in arrays:
+            if a is None:
+                specs.append(None)
+                shared.append(None)
+                continue
+            shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+            blocks.append(shm)
+            shared.append(np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf))
+            specs.append((shm.name, a.dtype.str, a.size))
+        for index in range(4): np.copyto(shared[index], arrays[index]) # Inputs
+
+        bounds = np.linspace(0, n, workers + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_parallelWorker, specs, bounds[i], bounds[i+1], options)
+                       for i in range(workers) if bounds[i+1] > bounds[i]]
+            nFallback = sum(f.result() for f in futures)
+
+        for index in range(4, len(arrays)): # Outputs
+            if arrays[index] is not None: np.copyto(arrays[index], shared[index])
+        return nFallback
+    finally:
+        shared.clear() # Release the views before closing
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+def _vincenty(work:_Workspace, dist:np.array, criteria:float, maxIterations:int) -> int:
+    '''
+    Vincenty's inverse iteration with per-pair convergence masking.
+    The index array active holds the pairs still iterating, so converged pairs drop out.
+    The distance in meters is stored in dist, the converged flags and iteration counts
+    are stored in work, and the number of pairs which did not converge is returned.
+    '''
+    (sinU1, cosU1, sinU2, cosU2, dLon) = \
+            (work.sinU1, work.cosU1, work.sinU2, work.cosU2, work.dLon)
+    (sigma, sinSigma, cosSigma, cos2Sigma, cosAlpha2) = \
+            (work.sigma, work.sinSigma, work.cosSigma, work.cos2Sigma, work.cosAlpha2)
+    (converged, iterations) = (work.converged, work.iterations)
+    converged[:] = False
+
+    active = np.arange(dLon.size) # Indices of pairs still iterating
     lambdaTerm = dLon # Initial guess of the lambda term
+    (aSinU1, aCosU1, aSinU2, aCosU2, aDLon) = (sinU1, cosU1, sinU2, cosU2, dLon)
 
-    for cnt in range(10): # Iteration loop through Vincenty's inverse problem to get the distance
+    for cnt in range(1, maxIterations + 1): # Iterate through Vincenty's inverse problem
         sinLambda = np.sin(lambdaTerm)
         cosLambda = np.cos(lambdaTerm)
-        sinSigma = np.sqrt(
-                (cosU2 * sinLambda)**2 + 
-                (cosU1 * sinU2 - sinU1 * cosU2 * cosLambda)**2
+        aSinSigma = np.sqrt(
+                (aCosU2 * sinLambda)**2 + 
+                (aCosU1 * aSinU2 - aSinU1 * aCosU2 * cosLambda)**2
                 )
-        cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLambda
-        sigma = np.arctan2(sinSigma, cosSigma)
-        sinAlpha = cosU1 * cosU2 * sinLambda / np.sin(sigma)
-        cosAlpha2 = 1 - sinAlpha**2 # Trig identity
-        cos2Sigma = cosSigma - 2 * sinU1 * sinU2 / cosAlpha2
-        C = f / 16 * cosAlpha2 * (4 + f * (4 - 3 * cosAlpha2))
-        lambdaPrime = dLon + \
-                (1 - C) * f * sinAlpha * (
-                        sigma +
-                        C * sinSigma * (
-                            cos2Sigma + 
-                            C * cosSigma * (-1 + 2 * cos2Sigma**2)
+        aCosSigma = aSinU1 * aSinU2 + aCosU1 * aCosU2 * cosLambda
+        aSigma = np.arctan2(aSinSigma, aCosSigma)
+        with np.errstate(divide="ignore", invalid="ignore"): # Same points, equatorial lines
+            sinAlpha = aCosU1 * aCosU2 * sinLambda / aSinSigma
+            aCosAlpha2 = 1 - sinAlpha**2 # Trig identity
+            aCos2Sigma = np.where(aCosAlpha2 != 0,
+                                  aCosSigma - 2 * aSinU1 * aSinU2 / aCosAlpha2, 0)
+        C = flattening / 16 * aCosAlpha2 * (4 + flattening * (4 - 3 * aCosAlpha2))
+        lambdaPrime = aDLon + \
+                (1 - C) * flattening * sinAlpha * (
+                        aSigma +
+                        C * aSinSigma * (
+                            aCos2Sigma + 
+                            C * aCosSigma * (-1 + 2 * aCos2Sigma**2)
                             )
                         )
         delta = np.abs(lambdaTerm - lambdaPrime)
         lambdaTerm = lambdaPrime
-        if delta.max() < criteria: break
 
-    u2 = cosAlpha2 * (rMajor**2 - rMinor**2) / rMinor**2
-    A = 1 + u2/16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
-    B = u2/1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
-    deltaSigma = B * sinSigma * (
-            cos2Sigma + 
-            B / 4 * (
-                cosSigma * (-1 + 2 * cos2Sigma**2) - 
-                B/6 * cos2Sigma * (-3 + 4 * sinSigma**2) * (-3 + 4 * cos2Sigma**2))
-             )
+        qDone = np.logical_not(delta >= criteria) # NaNs drop out too
+        with np.errstate(invalid="ignore"):
+            qFail = np.abs(lambdaPrime) > np.pi # Wandered off, nearly antipodal
+        qStop = np.logical_or(qDone, qFail)
+        if cnt == maxIterations: qStop[:] = True
+
+        if qStop.any():
+            ii = active[qStop]
+            sigma[ii] = aSigma[qStop]
+            sinSigma[ii] = aSinSigma[qStop]
+            cosSigma[ii] = aCosSigma[qStop]
+            cos2Sigma[ii] = aCos2Sigma[qStop]
+            cosAlpha2[ii] = aCosAlpha2[qStop]
+            converged[ii] = np.logical_and(qDone[qStop], np.logical_not(qFail[qStop]))
+            iterations[ii] = cnt
+
+            qKeep = np.logical_not(qStop)
+            active = active[qKeep]
+            if not active.size: break
+            lambdaTerm = lambdaTerm[qKeep]
+            aSinU1 = aSinU1[qKeep]
+            aCosU1 = aCosU1[qKeep]
+            aSinU2 = aSinU2[qKeep]
+            aCosU2 = aCosU2[qKeep]
+            aDLon = aDLon[qKeep]
+
+    with np.errstate(invalid="ignore"): # Same points are NaN here, zeroed by the caller
+        (A, deltaSigma) = _ellipsoidTerms(sinSigma, cosSigma, cos2Sigma, cosAlpha2)
+        np.subtract(sigma, deltaSigma, out=sigma) # Reuse sigma's buffer
+        sigma *= A
+        np.multiply(sigma, rMinor, out=dist) # Distance on the elipsoid
+
+    qFallback = np.logical_not(converged)
+    nFallback = int(qFallback.sum())
+    if nFallback:
+        dist[qFallback] = _antipodal(sinU1[qFallback], cosU1[qFallback],
+                                     sinU2[qFallback], cosU2[qFallback], dLon[qFallback])
+    return nFallback
+
+def _pickMethod(method:Method, tolerance:float, units:Units) -> Method:
+    ''' Resolve Auto to the cheapest method whose error bound is within tolerance '''
+    method = Method(method)
+    if method != Method.Auto: return method
+    if tolerance is None: raise ValueError("The auto method requires a tolerance")
+    for (key, err) in methodErrors.items():
+        if err * units <= tolerance: return key
+    return Method.Vincenty
+
+def _geodeticLatitude(sinU:np.array, cosU:np.array) -> tuple:
+    ''' Sine and cosine of the geodetic latitude from the reduced latitude '''
+    tanLat = sinU / ((1 - flattening) * cosU)
+    cosLat = 1 / np.sqrt(1 + tanLat**2)
+    return (tanLat * cosLat, cosLat)
+
+def _haversine(work:_Workspace, dist:np.array) -> None:
+    ''' Haversine distance on a sphere of the ellipsoid's mean radius '''
+    (sinLat1, cosLat1) = _geodeticLatitude(work.sinU1, work.cosU1)
+    (sinLat2, cosLat2) = _geodeticLatitude(work.sinU2, work.cosU2)
+    # sin^2 of half the latitude difference, sin(a-b) = sin(a)cos(b) - cos(a)sin(b)
+    sinHalfLat2 = (1 - (cosLat1 * cosLat2 + sinLat1 * sinLat2)) / 2
+    h = sinHalfLat2 + cosLat1 * cosLat2 * np.sin(work.dLon / 2)**2
+    np.arcsin(np.sqrt(np.clip(h, 0, 1)), out=dist)
+    dist *= 2 * rMean
+
+def _andoyer(work:_Workspace, dist:np.array) -> None:
+    ''' Andoyer-Lambert first order flattening correction to the spherical distance '''
+    (sinLat1, cosLat1) = _geodeticLatitude(work.sinU1, work.cosU1)
+    (sinLat2, cosLat2) = _geodeticLatitude(work.sinU2, work.cosU2)
+    cosD = np.clip(sinLat1 * sinLat2 + cosLat1 * cosLat2 * np.cos(work.dLon), -1, 1)
+    d = np.arccos(cosD)
+    threeSinD = 3 * np.sin(d)
+    K = (sinLat1 - sinLat2)**2
+    L = (sinLat1 + sinLat2)**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        H = np.where(cosD != 1, (d + threeSinD) / (1 - cosD), 0)
+        G = np.where(cosD != -1, (d - threeSinD) / (1 + cosD), 0)
+    np.multiply(rMajor, d - flattening / 4 * (H * K + G * L), out=dist)
+
+def _thomas(work:_Workspace, dist:np.array) -> None:
+    ''' Thomas's second order flattening expansion on the reduced latitudes '''
+    theta1 = np.arctan2(work.sinU1, work.cosU1)
+    theta2 = np.arctan2(work.sinU2, work.cosU2)
+    sinThetaM2 = np.sin((theta1 + theta2) / 2)**2
+    cosThetaM2 = 1 - sinThetaM2
+    sinDTheta2 = np.sin((theta2 - theta1) / 2)**2
+    cosDTheta2 = 1 - sinDTheta2
+    H = cosThetaM2 - sinDTheta2
+    L = sinDTheta2 + H * np.sin(work.dLon / 2)**2
+    cosD = 1 - 2 * L
+    d = np.arccos(np.clip(cosD, -1, 1))
+    sinD = np.sin(d)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        U = 2 * sinThetaM2 * cosDTheta2 / (1 - L)
+        V = 2 * sinDTheta2 * cosThetaM2 / L
+        X = U + V
+        Y = U - V
+        T = d / sinD
+        D = 4 * T * T
+        E = 2 * cosD
+        A = D * E
+        B = 2 * D
+        C = T - (A - E) / 2
+        delta1 = flattening * (T * X - Y) / 4
+        delta2 = flattening**2 * (X * (A + C * X) - Y * (B + E * Y) + D * X * Y) / 64
+        np.multiply(rMajor * sinD, T - delta1 + delta2, out=dist)
+    # Degenerate, antipodal, or same points, fall back to the spherical term
+    q = np.logical_not(np.isfinite(dist))
+    if q.any(): dist[q] = rMajor * d[q]
+
+def _vincentyFar(work:_Workspace, dist:np.array, criteria:float, maxIterations:int) -> int:
+    ''' Replace closed form distances beyond closedFormLimit with Vincenty's '''
+    index = np.flatnonzero(dist > closedFormLimit)
+    if not index.size: return 0
+    far = _Workspace(index.size, work.dLon.dtype)
+    for key in ("sinU1", "cosU1", "sinU2", "cosU2", "dLon"):
+        np.take(getattr(work, key), index, out=getattr(far, key))
+    d = np.empty(index.size, dtype=work.dLon.dtype)
+    nFallback = _vincenty(far, d, criteria, maxIterations)
+    dist[index] = d
+    work.converged[index] = far.converged
+    work.iterations[index] = far.iterations
+    return nFallback
+
+_closedForms = {
+        Method.Thomas: _thomas,
+        Method.Andoyer: _andoyer,
+        Method.Haversine: _haversine,
+        }
+
+def _pairBlocks(lon1:np.array, lat1:np.array, lon2:np.array, lat2:np.array,
+                criteria:float, maxIterations:int, blockSize:int):
+    '''
+    Generator of (i0, i1, distance) for blocks of rows of the pairwise distance matrix
+    in meters. Only one block, about blockSize pairs, is held in memory at a time.
+    '''
+    side1 = _Side(lon1, lat1)
+    side2 = _Side(lon2, lat2)
+    (n, m) = (side1.lon.size, side2.lon.size)
+    rows = max(1, min(n, int(blockSize) // max(m, 1)))
+    work = _Workspace(rows * m)
+    dist = np.empty(rows * m)
+    nFallback = 0
+    for i0 in range(0, n, rows):
+        i1 = min(i0 + rows, n)
+        w = work.view((i1 - i0) * m)
+        shape = w.loadPairs(side1, side2, i0, i1)
+        d = dist[:w.size]
+        nFallback += _vincenty(w, d, criteria, maxIterations)
+        d = d.reshape(shape)
+        # Same points
+        d[np.logical_and(side1.lat[i0:i1, None] == side2.lat[None, :],
+                         side1.lon[i0:i1, None] == side2.lon[None, :])] = 0
+        yield (i0, i1, d)
+    if nFallback:
+        logging.warning("%s of %s pairs did not converge, using antipodal approximation",
+                        nFallback, n * m)
+
+def pairwise(lon1:np.array, lat1:np.array, lon2:np.array, lat2:np.array,
+             units:Units=Units.Meters, criteria:float=1e-12, maxIterations:int=200,
+             out:np.array=None, blockSize:int=2**20) -> np.array:
+    '''
+    N by M matrix of distances between every point in (lon1, lat1) and (lon2, lat2)
+
+    The reduced latitude terms are computed once per point and the matrix is filled
+    blockSize pairs at a time, so no repeated coordinate arrays are built.
+    out: N by M array to store the distances in, e.g. an np.memmap, it is also returned
+    '''
+    n = np.broadcast(np.asarray(lon1), np.asarray(lat1)).size
+    m = np.broadcast(np.asarray(lon2), np.asarray(lat2)).size
+    if out is None:
+        out = np.empty((n, m))
+    elif out.shape != (n, m):
+        raise ValueError(f"out shape {out.shape} does not match ({n}, {m})")
+    for (i0, i1, dist) in _pairBlocks(lon1, lat1, lon2, lat2,
+                                      criteria, maxIterations, blockSize):
+        np.multiply(dist, units, out=out[i0:i1])
+    return out
+
+def nearest(lon1:np.array, lat1:np.array, lon2:np.array, lat2:np.array, k:int=1,
+            units:Units=Units.Meters, criteria:float=1e-12, maxIterations:int=200,
+            blockSize:int=2**20) -> tuple:
+    '''
+    For each point in (lon1, lat1) find the k nearest points in (lon2, lat2)
+
+    Returns (indices, distances), each N by k and sorted by distance, where indices
+    are into (lon2, lat2). The full distance matrix is never held in memory.
+    '''
+    m = np.broadcast(np.asarray(lon2), np.asarray(lat2)).size
+    k = min(int(k), m)
+    n = np.broadcast(np.asarray(lon1), np.asarray(lat1)).size
+    indices = np.empty((n, k), dtype=int)
+    distances = np.empty((n, k))
+    for (i0, i1, dist) in _pairBlocks(lon1, lat1, lon2, lat2,
+                                      criteria, maxIterations, blockSize):
+        if k < m:
+            ii = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            ii = np.broadcast_to(np.arange(m), dist.shape)
+        dd = np.take_along_axis(dist, ii, axis=1)
+        order = np.argsort(dd, axis=1)
+        indices[i0:i1] = np.take_along_axis(ii, order, axis=1)
+        distances[i0:i1] = np.take_along_axis(dd, order, axis=1)
+    distances *= units
+    return (indices, distances)
 
-    a = np.zeros(qSame.shape)
-    a[qDiff] = units * rMinor * A * (sigma - deltaSigma) # Distance on the elipsoid
-    return a
+def within(lon1:np.array, lat1:np.array, lon2:np.array, lat2:np.array, radius:float,
+           units:Units=Units.Meters, criteria:float=1e-12, maxIterations:int=200,
+           blockSize:int=2**20) -> tuple:
+    '''
+    All pairs of points in (lon1, lat1) and (lon2, lat2) which are at most radius apart
+
+    radius is in units. Returns (i, j, distances) where i indexes (lon1, lat1) and
+    j indexes (lon2, lat2). The full distance matrix is never held in memory.
+    '''
+    iList = []
+    jList = []
+    dList = []
+    for (i0, i1, dist) in _pairBlocks(lon1, lat1, lon2, lat2,
+                                      criteria, maxIterations, blockSize):
+        (i, j) = np.nonzero(dist * units <= radius)
+        iList.append(i + i0)
+        jList.append(j)
+        dList.append(dist[i, j] * units)
+    if not iList: return (np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0))
+    return (np.concatenate(iList), np.concatenate(jList), np.concatenate(dList))
+
+def _trackSteps(lon:np.array, lat:np.array, trackID:np.array, qBridgeGaps:bool,
+                criteria:float, maxIterations:int, chunkSize:int) -> tuple:
+    '''
+    Distance in meters from the previous point for each valid point of a track.
+    Returns (valid, steps, qStart) where steps and qStart are for the valid points only,
+    and qStart marks the first point of each segment, whose step is zero.
+    '''
+    (lon, lat) = np.broadcast_arrays(np.asarray(lon, dtype=float),
+                                     np.asarray(lat, dtype=float))
+    (lon, lat) = (lon.reshape(-1), lat.reshape(-1))
+    valid = np.logical_and(np.isfinite(lon), np.isfinite(lat))
+    index = np.flatnonzero(valid)
+    if index.size != valid.size: (lon, lat) = (lon[valid], lat[valid])
+
+    side = _Side(lon, lat) # Reduced latitude terms once per point
+    n = side.lon.size
+    steps = np.zeros(n)
+    qStart = np.zeros(n, dtype=bool)
+    if not n: return (valid, steps, qStart)
+
+    nSegments = n - 1
+    chunkSize = max(1, nSegments if chunkSize is None else min(int(chunkSize), nSegments))
+    work = _Workspace(chunkSize)
+    nFallback = 0
+    for i0 in range(0, nSegments, chunkSize):
+        i1 = min(i0 + chunkSize, nSegments)
+        w = work.view(i1 - i0)
+        w.loadTrack(side, i0, i1)
+        nFallback += _vincenty(w, steps[i0+1:i1+1], criteria, maxIterations)
+    if nFallback:
+        logging.warning("%s of %s segments did not converge, using antipodal approximation",
+                        nFallback, nSegments)
+
+    qStart[0] = True
+    if trackID is not None: # Points of a track are contiguous
+        trackID = np.asarray(trackID).reshape(-1)[valid]
+        qStart[1:] |= trackID[1:] != trackID[:-1]
+    if not qBridgeGaps: # A NaN point ends a segment
+        qStart[1:] |= np.diff(index) > 1
+    steps[qStart] = 0
+    # Same points
+    steps[1:][np.logical_and(side.lon[1:] == side.lon[:-1], side.lat[1:] == side.lat[:-1])] = 0
+    return (valid, steps, qStart)
+
+def trackDistance(lon:np.array, lat:np.array, trackID:np.array=None,
+                  units:Units=Units.Meters, qBridgeGaps:bool=False,
+                  criteria:float=1e-12, maxIterations:int=200,
+                  chunkSize:int=None) -> np.array:
+    '''
+    Distance from the previous point along an ordered track, zero at the start of a segment
+
+    The reduced latitude terms are computed once per point and shared by the two
+    segments on either side of it. Points with a NaN position are NaN.
+    trackID: optional per point track identifier, e.g. a platform name. The points of
+             each track must be contiguous, e.g. sorted by trackID then time.
+    qBridgeGaps: if True, measure across NaN points from the last valid position,
+                 otherwise a NaN point starts a new segment
+    '''
+    (valid, steps, qStart) = _trackSteps(lon, lat, trackID, qBridgeGaps,
+                                         criteria, maxIterations, chunkSize)
+    dist = np.full(valid.shape, np.nan)
+    dist[valid] = steps * units
+    return dist
+
+def cumulativeDistance(lon:np.array, lat:np.array, trackID:np.array=None,
+                       units:Units=Units.Meters, qBridgeGaps:bool=False,
+                       criteria:float=1e-12, maxIterations:int=200,
+                       chunkSize:int=None) -> np.array:
+    '''
+    Cumulative along track distance, restarting at zero at the start of each segment
+
+    See trackDistance for the arguments.
+    '''
+    (valid, steps, qStart) = _trackSteps(lon, lat, trackID, qBridgeGaps,
+                                         criteria, maxIterations, chunkSize)
+    total = np.cumsum(steps)
+    iStart = np.maximum.accumulate(np.where(qStart, np.arange(qStart.size), 0))
+    dist = np.full(valid.shape, np.nan)
+    if total.size: dist[valid] = (total - total[iStart]) * units
+    return dist
 
 class DistanceDegree:
     def __init__(self, distPerDeg:float, degRef:float) -> None:
@@ -106,13 +791,107 @@ class DistanceDegree:
 
 class Dist2Lon(DistanceDegree):
     def __init__(self, latRef:float, lonRef:float, re:Units=Units.Meters) -> None:
-        DistanceDegree.__init__(self, 
-                float(greatCircle(lonRef-0.5, latRef, lonRef+0.5, latRef, re)), lonRef)
+        DistanceDegree.__init__(self, float(metersPerDegree(latRef)[0] * re), lonRef)
 
 class Dist2Lat(DistanceDegree):
     def __init__(self, latRef:float, lonRef:float, re:Units=Units.Meters) -> None:
-        DistanceDegree.__init__(self, 
-                float(greatCircle(lonRef, latRef-0.5, lonRef, latRef+0.5, re)), latRef)
+        DistanceDegree.__init__(self, float(metersPerDegree(latRef)[1] * re), latRef)
+
+eccentricity2 = flattening * (2 - flattening) # First eccentricity squared
+latitudeQuantum = 1e-7 # Degrees, reference latitudes are rounded to this for caching
+
+@lru_cache(maxsize=65536)
+def _metersPerDegreeCached(qLat:int) -> tuple:
+    return tuple(float(x) for x in _metersPerDegree(qLat * latitudeQuantum))
+
+def _metersPerDegree(lat:np.array) -> tuple:
+    ''' Meters per degree of longitude and latitude from the radii of curvature '''
+    lat = np.deg2rad(lat)
+    w2 = 1 - eccentricity2 * np.sin(lat)**2
+    N = rMajor / np.sqrt(w2) # Prime vertical radius of curvature
+    M = rMajor * (1 - eccentricity2) / (w2 * np.sqrt(w2)) # Meridional radius of curvature
+    return (np.deg2rad(N * np.cos(lat)), np.deg2rad(M))
+
+def metersPerDegree(lat:np.array) -> tuple:
+    '''
+    Meters per degree of longitude and of latitude on the WGS-84 ellipsoid at lat
+
+    Scalars go through an LRU cache keyed by lat rounded to latitudeQuantum,
+    arrays are computed once per unique rounded latitude. NaN or infinite
+    latitudes, e.g. missing fixes in a track, give NaN.
+    '''
+    qLat = np.rint(np.asarray(lat, dtype=float) / latitudeQuantum)
+    if qLat.ndim == 0:
+        if not np.isfinite(qLat): return (np.nan, np.nan)
+        return _metersPerDegreeCached(int(qLat))
+    qLat = np.where(np.isfinite(qLat), qLat, np.nan)
+    (uLat, index) = np.unique(qLat, return_inverse=True)
+    (mLon, mLat) = _metersPerDegree(uLat * latitudeQuantum)
+    return (mLon[index].reshape(qLat.shape), mLat[index].reshape(qLat.shape))
+
+# Series coefficients in the third flattening for the meridian arc and its inverse
+_n = flattening / (2 - flattening)
+_meridianScale = rMajor / (1 + _n) * (1 + _n**2 / 4 + _n**4 / 64) # Rectifying radius
+_meridianForward = (-3/2 * _n + 9/16 * _n**3, 15/16 * _n**2 - 15/32 * _n**4,
+                    -35/48 * _n**3, 315/512 * _n**4)
+_meridianInverse = (3/2 * _n - 27/32 * _n**3, 21/16 * _n**2 - 55/32 * _n**4,
+                    151/96 * _n**3, 1097/512 * _n**4)
+
+def meridianArc(lat:np.array) -> np.array:
+    ''' Distance in meters along a meridian from the equator to lat '''
+    mu = np.deg2rad(lat)
+    total = mu.copy() if isinstance(mu, np.ndarray) else mu
+    for (k, c) in enumerate(_meridianForward, start=1):
+        total = total + c * np.sin(2 * k * mu)
+    return _meridianScale * total
+
+def meridianLatitude(dist:np.array) -> np.array:
+    ''' Latitude reached a distance in meters along a meridian from the equator '''
+    mu = np.asarray(dist, dtype=float) / _meridianScale # Rectifying latitude
+    lat = mu.copy()
+    for (k, c) in enumerate(_meridianInverse, start=1):
+        lat = lat + c * np.sin(2 * k * mu)
+    return np.rad2deg(lat)
+
+class LocalProjection:
+    '''
+    Vectorized conversion between lon/lat and local x/y distances about reference points
+
+    lonRef and latRef may be arrays, one reference per point, e.g. per grid cell or
+    profile. The linear mapping uses the meters per degree at the reference latitude.
+    With qSeries, y is the meridian arc from latRef and x is the arc along the parallel
+    of each point, so the mapping stays accurate away from the reference.
+    '''
+    def __init__(self, lonRef:np.array, latRef:np.array, units:Units=Units.Meters,
+                 qSeries:bool=False) -> None:
+        self.lonRef = np.asarray(lonRef, dtype=float)
+        self.latRef = np.asarray(latRef, dtype=float)
+        self.units = units
+        self.qSeries = qSeries
+        (self.distPerDegLon, self.distPerDegLat) = \
+                (x * units for x in metersPerDegree(self.latRef))
+        if qSeries: self.__arcRef = meridianArc(self.latRef)
+
+    def __repr__(self) -> str:
+        return f"LocalProjection({self.lonRef}, {self.latRef}, series {self.qSeries})"
+
+    def forward(self, lon:np.array, lat:np.array) -> tuple:
+        ''' lon/lat in degrees to (x, y) in units east and north of the reference '''
+        dLon = np.remainder(np.asarray(lon, dtype=float) - self.lonRef + 180, 360) - 180
+        if not self.qSeries:
+            return (dLon * self.distPerDegLon,
+                    (np.asarray(lat, dtype=float) - self.latRef) * self.distPerDegLat)
+        (mLon, mLat) = _metersPerDegree(lat)
+        return (dLon * mLon * self.units, (meridianArc(lat) - self.__arcRef) * self.units)
+
+    def inverse(self, x:np.array, y:np.array) -> tuple:
+        ''' (x, y) in units east and north of the reference to lon/lat in degrees '''
+        if not self.qSeries:
+            return (self.lonRef + np.asarray(x, dtype=float) / self.distPerDegLon,
+                    self.latRef + np.asarray(y, dtype=float) / self.distPerDegLat)
+        lat = meridianLatitude(self.__arcRef + np.asarray(y, dtype=float) / self.units)
+        (mLon, mLat) = _metersPerDegree(lat)
+        return (self.lonRef + np.asarray(x, dtype=float) / self.units / mLon, lat)
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
@@ -132,6 +911,12 @@ if __name__ == "__main__":
             df["delta"] = df.dist - df.dist2
             print(df)
             print("max difference", df.delta.max())
+            q = df.dist <= closedFormLimit
+            for method in methodErrors:
+                delta = (df.dist - greatCircle(df.lon0, df.lat0, df.lon1, df.lat1,
+                                               method=method)).abs()
+                print(method.value, "max difference", delta[q].max(),
+                      "bound", methodErrors[method], "beyond limit", delta[~q].max())
     else: # Some uniform spacing
         n = 10
         df = pd.DataFrame({"lat1": np.linspace(-50,50,n), "lon1": np.linspace(-180,180,n)})
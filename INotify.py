@@ -3,35 +3,377 @@
 # Use pyinotify to handle file notification and send
 # the notification to a queue
 #
+# Optionally, events are coalesced per path until the path has been quiet for a while,
+# so a file being written sends one record instead of one per IN_MODIFY.
+#
+# Consumers may subscribe with a path filter and an event mask to get their own queue.
+#
+# Queues may be bounded BatchQueues, whose get returns a list of events. If the kernel's
+# event queue overflows, the watched trees are rescanned for files modified since
+# the last event, and events are synthesized for them.
+#
+# addTree registers trees with an os.scandir walk, optionally in parallel. An optional
+# snapshot of the files, (path, size, mtime), is saved periodically and on stop, and
+# optionally at exit, and compared against on startup, so files which arrived while the
+# service was down are sent as events.
+#
 
 from argparse import ArgumentParser
+from collections import OrderedDict, namedtuple, deque
 import pyinotify
+import atexit
+import gzip
+import json
+import threading
+import fnmatch
 import queue
 import logging
+import re
 import time
 import os
 try:
     from .Thread import Thread # As a module
+    from .Metrics import metrics, TimedQueue
 except:
     from Thread import Thread # From within module
+    from Metrics import metrics, TimedQueue
+
+# What is put on the queue when coalescing, t0/t1 are the first/last event times,
+# mask is the or of all the event masks, and count is the number of events merged
+Coalesced = namedtuple("Coalesced", ["t0", "fn", "mask", "t1", "count"])
+
+def _scanDirectory(path:str, qFiles:bool=False) -> tuple:
+    ''' (subdirectories, {filename: (size, mtime_ns)} if qFiles) of path '''
+    dirs = []
+    files = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif qFiles and entry.is_file(follow_symlinks=False):
+                        info = entry.stat(follow_symlinks=False)
+                        files[entry.path] = (info.st_size, info.st_mtime_ns)
+                except FileNotFoundError: # Removed while scanning
+                    pass
+    except OSError as e:
+        logging.warning("Unable to scan %s, %s", path, e)
+    return (dirs, files)
+
+def walkTree(root:str, workers:int=None, progressInterval:float=10) -> list:
+    '''
+    All the directories in the tree below and including root, found with os.scandir,
+    in workers threads if workers is more than one. The count so far is logged every
+    progressInterval seconds.
+    '''
+    dirs = [root]
+    tNext = time.time() + progressInterval
+    if not workers or workers <= 1:
+        stack = [root]
+        while stack:
+            (subdirs, files) = _scanDirectory(stack.pop())
+            dirs.extend(subdirs)
+            stack.extend(subdirs)
+            if time.time() >= tNext:
+                logging.info("Scanned %s directories in %s", len(dirs), root)
+                tNext = time.time() + progressInterval
+        return dirs
+
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait # Only when used
+    with ThreadPoolExecutor(max_workers=workers) as pool: # scandir releases the GIL
+        pending = {pool.submit(_scanDirectory, root)}
+        while pending:
+            (done, pending) = wait(pending, timeout=progressInterval,
+                                   return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs = future.result()[0]
+                dirs.extend(subdirs)
+                pending.update(pool.submit(_scanDirectory, path) for path in subdirs)
+            if time.time() >= tNext:
+                logging.info("Scanned %s directories in %s", len(dirs), root)
+                tNext = time.time() + progressInterval
+    return dirs
+
+def statFiles(dirs:list, workers:int=None) -> dict:
+    ''' {filename: (size, mtime_ns)} for the files directly in each of dirs '''
+    files = {}
+    scan = lambda path: _scanDirectory(path, qFiles=True)[1]
+    if not workers or workers <= 1:
+        for path in dirs: files.update(scan(path))
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for item in pool.map(scan, dirs, chunksize=64): files.update(item)
+    return files
+
+class BatchQueue:
+    '''
+    A queue.Queue like FIFO, which may be bounded, where get returns a list of items.
+    When it is full, put either blocks, policy "block", or drops the oldest item,
+    policy "dropOldest", with the number dropped kept in self.dropped.
+    If metrics are enabled when it is made, the depth and put to get latency are recorded.
+    As with queue.Queue, join waits until task_done has been called for everything put,
+    but task_done is called once per list returned by get, not once per item. Dropped
+    items are done when they are dropped.
+    '''
+    policies = ("block", "dropOldest")
+
+    def __init__(self, maxsize:int=0, policy:str="block", maxBatch:int=None,
+                 name:str="BatchQueue") -> None:
+        '''
+        maxsize: maximum number of items held, 0 for unbounded
+        policy: "block" or "dropOldest"
+        maxBatch: maximum number of items returned by one get, None for all of them
+        name: prefix of the metrics names
+        '''
+        if policy not in self.policies:
+            raise ValueError(f"Unknown policy {policy}, should be one of {self.policies}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.maxBatch = maxBatch
+        self.dropped = 0
+        self.name = name
+        self.__qTimed = metrics.enabled # Items are (time put, item)
+        self.__items = deque()
+        self.__lock = threading.Lock()
+        self.__notEmpty = threading.Condition(self.__lock)
+        self.__notFull = threading.Condition(self.__lock)
+        self.__allDone = threading.Condition(self.__lock)
+        self.__unfinished = 0 # Items put and not dropped or done
+        self.__batches = deque() # Sizes of the lists gotten and not yet done
+
+    def __repr__(self) -> str:
+        return f"BatchQueue({self.qsize()}/{self.maxsize}, {self.policy}, {self.dropped} dropped)"
+
+    def qsize(self) -> int:
+        with self.__lock: return len(self.__items)
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    def put(self, item, block:bool=True, timeout:float=None) -> None:
+        self.putMany((item,), block, timeout)
+
+    def putMany(self, items:list, block:bool=True, timeout:float=None) -> None:
+        ''' Put all of items with one lock acquisition, unless it has to wait for room '''
+        tEnd = None if timeout is None else (time.monotonic() + timeout)
+        with self.__lock:
+            for item in items:
+                while self.maxsize and len(self.__items) >= self.maxsize:
+                    if self.policy == "dropOldest":
+                        self.__items.popleft()
+                        self.dropped += 1
+                        self.__finished(1)
+                        continue
+                    self.__notEmpty.notify_all() # Let consumers drain what is there
+                    if not block: raise queue.Full
+                    dt = None if tEnd is None else (tEnd - time.monotonic())
+                    if dt is not None and dt <= 0: raise queue.Full
+                    self.__notFull.wait(dt)
+                self.__items.append((time.monotonic(), item) if self.__qTimed else item)
+                self.__unfinished += 1
+            if self.__qTimed:
+                metrics.highWater(self.name + " depth", len(self.__items))
+                if self.dropped: metrics.highWater(self.name + " dropped", self.dropped)
+            self.__notEmpty.notify_all()
+
+    def get(self, block:bool=True, timeout:float=None) -> list:
+        ''' Up to maxBatch items, waiting for at least one '''
+        tEnd = None if timeout is None else (time.monotonic() + timeout)
+        with self.__lock:
+            while not self.__items:
+                dt = None if tEnd is None else (tEnd - time.monotonic())
+                if not block or (dt is not None and dt <= 0): raise queue.Empty
+                self.__notEmpty.wait(dt)
+            n = len(self.__items) if self.maxBatch is None \
+                    else min(self.maxBatch, len(self.__items))
+            batch = [self.__items.popleft() for i in range(n)]
+            self.__batches.append(n)
+            self.__notFull.notify_all()
+        if self.__qTimed:
+            t0 = time.monotonic()
+            for (t, item) in batch: metrics.observe(self.name + " latency", t0 - t)
+            batch = [item for (t, item) in batch]
+        return batch
+
+    def get_nowait(self) -> list:
+        return self.get(False)
+
+    def task_done(self) -> None:
+        ''' The oldest list returned by get, not yet done, has been processed '''
+        with self.__lock:
+            if not self.__batches: raise ValueError("task_done() called too many times")
+            self.__finished(self.__batches.popleft())
+
+    def join(self) -> None:
+        ''' Wait until every item put has been dropped or processed '''
+        with self.__allDone:
+            while self.__unfinished: self.__allDone.wait()
+
+    def __finished(self, n:int) -> None:
+        ''' n items are done, called with the lock held '''
+        self.__unfinished -= n
+        if not self.__unfinished: self.__allDone.notify_all()
+
+class Subscription:
+    ''' A queue and the path and event mask filters for what is put on it '''
+    kinds = ("glob", "regex", "suffix")
+
+    def __init__(self, q:queue.Queue, pattern:str=None, kind:str="glob", mask:int=None) -> None:
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown kind {kind}, should be one of {self.kinds}")
+        self.queue = q
+        self.pattern = pattern
+        self.kind = kind
+        self.mask = mask
+        self.qBasename = kind == "glob" and pattern is not None and os.sep not in pattern
+        if pattern is None or kind == "suffix":
+            self.regex = None
+        else:
+            try: # Each pattern on its own, so a bad one is reported by name
+                self.regex = re.compile(fnmatch.translate(pattern) if kind == "glob" else pattern)
+            except re.error as e:
+                raise ValueError(f"Invalid {kind} pattern {pattern!r}, {e}") from e
+
+    def __repr__(self) -> str:
+        return f"Subscription({self.kind} {self.pattern}, {self.mask})"
+
+    def suffix(self) -> str:
+        ''' The literal suffix a path must end with, if this filter is only that '''
+        if self.kind == "suffix": return self.pattern
+        if self.kind == "glob" and self.pattern.startswith("*") \
+                and not any(c in self.pattern[1:] for c in "*?[]" + os.sep):
+            return self.pattern[1:] # *.nc
+        return None
+
+    def matches(self, fn:str, name:str) -> bool:
+        return self.regex.search(name if self.qBasename else fn) is not None
+
+class _Dispatch:
+    '''
+    Index of subscriptions built once per change so each event does not scan them all.
+    Suffix filters, including *.ext globs, are looked up by suffix, the remaining
+    patterns are screened by one combined regular expression before being tried.
+    Patterns which can not be combined, those with global inline flags such as (?i),
+    backreferences, or group conditionals, or if the combination fails to compile,
+    are always tried one by one.
+    '''
+    __qReferences = re.compile(r"\\[1-9]|\(\?P=|\(\?\(") # Refer to groups by number or name
+
+    def __init__(self, subscriptions:tuple) -> None:
+        self.subscriptions = subscriptions
+        self.everything = [] # No path filter
+        self.suffixes = {} # suffix -> [Subscription]
+        self.patterns = [] # Everything else
+        for sub in subscriptions:
+            suffix = None if sub.pattern is None else sub.suffix()
+            if sub.pattern is None:
+                self.everything.append(sub)
+            elif suffix is not None:
+                self.suffixes.setdefault(suffix, []).append(sub)
+            else:
+                self.patterns.append(sub)
+        self.lengths = sorted({len(suffix) for suffix in self.suffixes})
+        self.screened = [] # Tried when the combined expressions match
+        self.direct = [] # Always tried
+        for sub in self.patterns:
+            qAlone = (sub.regex.flags & ~re.UNICODE) or self.__qReferences.search(sub.regex.pattern)
+            (self.direct if qAlone else self.screened).append(sub)
+        self.full = self.__combine([sub for sub in self.screened if not sub.qBasename])
+        self.base = self.__combine([sub for sub in self.screened if sub.qBasename])
+
+    def __combine(self, subs:list) -> re.Pattern:
+        ''' One expression matching if any of subs do, or None and subs go to direct '''
+        if not subs: return None
+        try:
+            return re.compile("|".join(f"(?:{sub.regex.pattern})" for sub in subs))
+        except re.error as e: # e.g. the same group name in two patterns
+            logging.info("Unable to combine patterns, trying them one by one, %s", e)
+            self.screened = [sub for sub in self.screened if sub not in subs]
+            self.direct.extend(subs)
+            return None
+
+    def __call__(self, fn:str, mask:int) -> list:
+        ''' The subscriptions fn and mask match '''
+        subs = list(self.everything)
+        for n in self.lengths:
+            subs.extend(self.suffixes.get(fn[-n:], ()))
+        if self.patterns:
+            name = os.path.basename(fn)
+            if (self.full is not None and self.full.search(fn)) \
+                    or (self.base is not None and self.base.search(name)):
+                subs.extend(sub for sub in self.screened if sub.matches(fn, name))
+            subs.extend(sub for sub in self.direct if sub.matches(fn, name))
+        return [sub for sub in subs if sub.mask is None or (sub.mask & mask)]
 
 class INotify(Thread):
-    def __init__(self, args:ArgumentParser, flags:int=None) -> None:
+    # inotify event mask watched for by default
+    defaultFlags = pyinotify.IN_CREATE | pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE \
+            | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVE_SELF \
+            | pyinotify.IN_DELETE | pyinotify.IN_DELETE_SELF
+
+    # Events which mean a path is gone, so pending work for it is cancelled
+    cancelMask = pyinotify.IN_DELETE | pyinotify.IN_DELETE_SELF \
+            | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVE_SELF
+
+    # Mask of the events synthesized by a rescan after the kernel's queue overflowed
+    rescanMask = pyinotify.IN_Q_OVERFLOW | pyinotify.IN_CLOSE_WRITE
+    # Seconds before the last event seen to look for modified files in a rescan, since
+    # lost events may be for modifications made before the last event was handled
+    rescanSlack = 60
+    # Masks of the events synthesized from differences with the snapshot
+    snapshotMasks = {
+            "created": pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE,
+            "modified": pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE,
+            "deleted": pyinotify.IN_DELETE,
+            }
+
+    def __init__(self, args:ArgumentParser, flags:int=None, quietPeriod:float=None,
+                 maxQueue:int=None, policy:str="block", maxBatch:int=None,
+                 snapshot:str=None, snapshotInterval:float=None,
+                 qSaveAtExit:bool=False) -> None:
+        '''
+        flags: inotify event mask to watch for
+        quietPeriod: if not None, merge the events for each path and put a single
+                     Coalesced record on the queue once there have been no events
+                     for the path for quietPeriod seconds, instead of (t0, fn) per event.
+                     Deletes and renames away cancel the pending record for the path
+                     and anything below it, and are sent at once as a record of their own.
+        maxQueue, policy, maxBatch: if maxQueue or maxBatch is not None, self.queue and
+                     subscription queues are BatchQueues with these arguments
+        snapshot: filename of the snapshot of the files in the trees added by addTree.
+                  Each addTree sends events for the differences from the snapshot. It is
+                  saved by saveSnapshot, which stop calls, so call stop on shutdown.
+        snapshotInterval: if not None, also save the snapshot every this many seconds,
+                          in its own thread
+        qSaveAtExit: also call stop at exit. A service stopped by systemd gets a SIGTERM,
+                     for which atexit handlers only run if the application makes SIGTERM
+                     exit, e.g. signal.signal(signal.SIGTERM, lambda *a: sys.exit(143))
+        '''
         Thread.__init__(self, "INotify", args)
         self.__wm = pyinotify.WatchManager()
-        self.__notifier = pyinotify.Notifier(self.__wm)
-        self.queue = queue.Queue()
-        if flags is not None:
-            self.__flags = flags
-        else:
-            self.__flags = pyinotify.IN_CREATE 
-            self.__flags|= pyinotify.IN_MODIFY 
-            self.__flags|= pyinotify.IN_CLOSE_WRITE 
-            self.__flags|= pyinotify.IN_MOVED_TO 
-            self.__flags|= pyinotify.IN_MOVED_FROM
-            self.__flags|= pyinotify.IN_MOVE_SELF
-            self.__flags|= pyinotify.IN_DELETE
-            self.__flags|= pyinotify.IN_DELETE_SELF
+        self.__notifier = pyinotify.Notifier(self.__wm, default_proc_fun=self.__overflow)
+        self.__queueArgs = None if maxQueue is None and maxBatch is None else \
+                dict(maxsize=maxQueue or 0, policy=policy, maxBatch=maxBatch)
+        self.queue = self.__mkQueue("INotify") # Subscribed to everything, see unsubscribe
+        self.__outgoing = {} # id(queue) -> (queue, [items]) delivered once per read
+        self.__roots = {} # Watched directories -> (mask, qRecursive, qAutoAdd), for rescans
+        self.__tLast = time.time() # Time of the last event, rescans look for newer files
+        self.__lock = threading.Lock()
+        self.__eventLock = threading.Lock() # Events synthesized outside of the loop
+        self.__snapshot = None if snapshot is None else \
+                os.path.abspath(os.path.expanduser(snapshot))
+        self.__oldSnapshot = self.__loadSnapshot()
+        self.__snapshotLock = threading.Lock() # One save at a time
+        self.__snapshotInterval = snapshotInterval
+        self.__tSave = None if self.__snapshot is None or snapshotInterval is None \
+                else (time.time() + snapshotInterval) # Time of the next periodic save
+        if self.__snapshot is not None and qSaveAtExit: atexit.register(self.__saveAtExit)
+        self.__dispatch = _Dispatch((Subscription(self.queue),))
+        self.__quietPeriod = quietPeriod
+        self.__pending = OrderedDict() # fn -> [t0, mask, t1, count], oldest t1 first
+        self.__flags = flags if flags is not None else self.defaultFlags
 
     @staticmethod
     def __maskname(mask:int) -> str:
@@ -42,8 +384,155 @@ class INotify(Thread):
             if mask & codes[key]: items.append(key)
         return "|".join(items) if items else None
 
-    def addTree(self, tgt:str) -> None:
-        self.addWatch(tgt, qRecursive=True, qAutoAdd=True)
+    def __mkQueue(self, name:str):
+        ''' A queue.Queue or BatchQueue, or their instrumented versions if metrics are on '''
+        if self.__queueArgs is not None: return BatchQueue(name=name, **self.__queueArgs)
+        return TimedQueue(name) if metrics.enabled else queue.Queue()
+
+    def subscribe(self, pattern:str=None, kind:str="glob", mask:int=None,
+                  q:queue.Queue=None) -> queue.Queue:
+        '''
+        Put the events whose path matches pattern and whose mask shares a bit with mask
+        on a queue of their own, which is returned.
+
+        pattern: glob, e.g. "*.nc" matched against the file name, or against the full path
+                 if it contains a /, regular expression searched for in the full path,
+                 or suffix of the full path, depending on kind. None matches everything.
+        kind: "glob", "regex", or "suffix"
+        mask: inotify event mask, None matches every event
+        q: queue to put the events on, by default a new queue like self.queue
+        '''
+        q = self.__mkQueue(f"INotify {pattern}") if q is None else q
+        sub = Subscription(q, pattern, kind, mask)
+        with self.__lock:
+            self.__dispatch = _Dispatch(self.__dispatch.subscriptions + (sub,))
+        logging.info("Subscribed %s", sub)
+        return q
+
+    def unsubscribe(self, q:queue.Queue) -> None:
+        '''
+        Stop putting events on q. self.queue gets every event until it is unsubscribed,
+        which should be done if only subscriptions are used so it does not grow.
+        '''
+        with self.__lock:
+            self.__dispatch = _Dispatch(tuple(sub for sub in self.__dispatch.subscriptions
+                                              if sub.queue is not q))
+
+    def __put(self, item:tuple, fn:str, mask:int) -> None:
+        outgoing = self.__outgoing
+        for sub in self.__dispatch(fn, mask):
+            key = id(sub.queue)
+            if key not in outgoing: outgoing[key] = (sub.queue, [])
+            outgoing[key][1].append(item)
+
+    def __deliver(self) -> None:
+        ''' Put everything from one read of events on the queues, a batch per queue '''
+        (outgoing, self.__outgoing) = (self.__outgoing, {})
+        for (q, items) in outgoing.values():
+            if isinstance(q, BatchQueue):
+                q.putMany(items)
+            else:
+                for item in items: q.put(item)
+
+    def addTree(self, tgt:str, workers:int=None, progressInterval:float=10) -> bool:
+        '''
+        Watch every directory in the tree below tgt, and new ones as they are created.
+        The directories are found with an os.scandir walk, in workers threads if more
+        than one, and added without globbing. Progress is logged every progressInterval
+        seconds. With a snapshot, events are sent for the differences from it.
+        '''
+        tgt = os.path.abspath(os.path.expanduser(tgt))
+        if not os.path.isdir(tgt):
+            logging.error("Path %s does not exist", tgt)
+            return False
+        t0 = time.time()
+        dirs = walkTree(tgt, workers, progressInterval)
+        logging.info("Found %s directories in %s in %.1f seconds", len(dirs), tgt,
+                     time.time() - t0)
+        mask = self.__flags
+        nBlock = 1000
+        tNext = time.time() + progressInterval
+        for i in range(0, len(dirs), nBlock):
+            self.__wm.add_watch(path=dirs[i:i+nBlock], mask=mask, proc_fun=self.__eventHandler,
+                    rec=False, auto_add=True, do_glob=False)
+            if time.time() >= tNext:
+                logging.info("Added %s of %s watches in %s", i + nBlock, len(dirs), tgt)
+                tNext = time.time() + progressInterval
+        self.__roots[tgt] = (mask, True, True)
+        logging.info("Added %s watches for %s in %.1f seconds, msk %s",
+                     len(dirs), tgt, time.time() - t0, self.__maskname(mask))
+        if self.__oldSnapshot is not None:
+            self.__compareSnapshot(tgt, statFiles(dirs, workers)) # After the watches exist
+        return True
+
+    def __loadSnapshot(self) -> dict:
+        ''' The saved snapshot, or None if there is none to compare against '''
+        if self.__snapshot is None or not os.path.isfile(self.__snapshot): return None
+        files = {}
+        try:
+            with gzip.open(self.__snapshot, "rt") as fp:
+                for line in fp:
+                    (fn, size, mtime) = json.loads(line)
+                    files[fn] = (size, mtime)
+        except Exception as e:
+            logging.warning("Unable to load snapshot %s, %s", self.__snapshot, e)
+            return None
+        logging.info("Loaded %s files from snapshot %s", len(files), self.__snapshot)
+        return files
+
+    def __compareSnapshot(self, root:str, files:dict) -> None:
+        ''' Synthesize events for the files under root which differ from the snapshot '''
+        prefix = root.rstrip(os.sep) + os.sep
+        old = {fn: self.__oldSnapshot.pop(fn) for fn in
+               [fn for fn in self.__oldSnapshot if fn.startswith(prefix)]}
+        changes = {key: [] for key in self.snapshotMasks}
+        for (fn, info) in files.items():
+            previous = old.pop(fn, None)
+            if previous is None:
+                changes["created"].append(fn)
+            elif tuple(previous) != info:
+                changes["modified"].append(fn)
+        changes["deleted"] = list(old)
+        t0 = time.time()
+        with self.__eventLock:
+            for (key, fns) in changes.items():
+                for fn in fns: self.__event(t0, fn, self.snapshotMasks[key])
+            if self.__quietPeriod is None: self.__deliver()
+        logging.info("Snapshot differences in %s, %s", root,
+                     ", ".join(f"{len(fns)} {key}" for (key, fns) in changes.items()))
+
+    def saveSnapshot(self, fn:str=None) -> None:
+        ''' Write the size and mtime of every file in the trees added by addTree '''
+        fn = self.__snapshot if fn is None else fn
+        if fn is None: return
+        roots = [root for (root, (mask, qRecursive, qAutoAdd)) in list(self.__roots.items())
+                 if qRecursive]
+        with self.__snapshotLock:
+            t0 = time.time()
+            tmp = fn + ".tmp"
+            n = 0
+            with gzip.open(tmp, "wt", compresslevel=1) as fp:
+                for root in roots:
+                    for (name, (size, mtime)) in statFiles(walkTree(root)).items():
+                        fp.write(json.dumps((name, size, mtime)) + "\n")
+                        n += 1
+            os.replace(tmp, fn) # Atomic, so a crash never leaves a partial snapshot
+        logging.info("Saved %s files to snapshot %s in %.1f seconds", n, fn, time.time() - t0)
+
+    def stop(self) -> None:
+        ''' Ask the loop to finish, at its next wake up, and save the snapshot '''
+        qSave = not self.stopping()
+        Thread.stop(self)
+        if qSave: self.saveSnapshot()
+
+    def __saveAtExit(self) -> None:
+        if not self.stopping(): self.stop() # Otherwise saved by stop already
+
+    def __periodicSave(self) -> None:
+        ''' Save the snapshot in its own thread, so the loop keeps reading events '''
+        self.__tSave = time.time() + self.__snapshotInterval
+        if self.__snapshotLock.locked(): return # The last one is still being saved
+        threading.Thread(target=self.saveSnapshot, name="saveSnapshot", daemon=True).start()
 
     def addWatch(self, tgt:str, mask:int=None, qRecursive:bool=False, qAutoAdd:bool=False) -> bool:
         tgt = os.path.abspath(os.path.expanduser(tgt))
@@ -51,6 +540,7 @@ class INotify(Thread):
             mask = mask if mask is not None else self.__flags
             self.__wm.add_watch(path=tgt, mask=mask, proc_fun=self.__eventHandler, 
                     rec=qRecursive, auto_add=qAutoAdd)
+            self.__roots[tgt] = (mask, qRecursive, qAutoAdd)
             logging.info("Added watch for %s, rec %s auto %s msk %s",
                     tgt, qRecursive, qAutoAdd, self.__maskname(mask))
             return True
@@ -59,44 +549,180 @@ class INotify(Thread):
 
     def runIt(self) -> None: # Called on thread start
         logging.info("Starting loop")
-        self.__notifier.loop() # All the action happens in __eventHandler
+        self.__loop() # All the action happens in __eventHandler
         logging.warning("Leaving loop")
 
+    def __loop(self) -> None:
+        '''
+        Like Notifier.loop, but the events from each read are delivered as one batch per
+        queue, and it wakes up to flush pending paths once they are quiet
+        '''
+        notifier = self.__notifier
+        while not self.stopping():
+            self.mark("loop")
+            with self.__eventLock, self.timed("handle"):
+                notifier.process_events()
+                if self.__quietPeriod is not None: self.__flush()
+                self.__deliver()
+                # Inside the lock, since rescans and snapshots change pending from other threads
+                timeout = None # Block until there is an event
+                if self.__pending:
+                    t1 = next(iter(self.__pending.values()))[2] # Oldest last event
+                    timeout = max(0, int(1000 * (t1 + self.__quietPeriod - time.time())) + 1)
+                elif self.__quietPeriod is not None: # Pick up synthesized events
+                    timeout = int(1000 * self.__quietPeriod) + 1
+            if self.__tSave is not None: # Wake up for the next periodic snapshot
+                if time.time() >= self.__tSave: self.__periodicSave()
+                dt = max(0, int(1000 * (self.__tSave - time.time())) + 1)
+                timeout = dt if timeout is None else min(timeout, dt)
+            if notifier.check_events(timeout):
+                notifier.read_events()
+
+    def __overflow(self, e:pyinotify.Event) -> None:
+        ''' Events without a watch, IN_Q_OVERFLOW means events were lost '''
+        if not (e.mask & pyinotify.IN_Q_OVERFLOW):
+            logging.debug("Unwatched event %s", e)
+            return
+        logging.warning("inotify queue overflowed, rescanning %s", sorted(self.__roots))
+        self.__rescan(self.__tLast - self.rescanSlack)
+
+    def __rescan(self, tSince:float) -> int:
+        '''
+        Synthesize events, with rescanMask, for the files in the watched directories
+        modified since tSince, and add watches for directories created below recursive
+        watches which have none. Returns the number of events.
+        '''
+        tNow = time.time()
+        cnt = 0
+        for (root, (mask, qRecursive, qAutoAdd)) in list(self.__roots.items()):
+            for (dirpath, dirnames, filenames) in os.walk(root):
+                if not qRecursive: dirnames.clear()
+                elif self.__wm.get_wd(dirpath) is None:
+                    self.__wm.add_watch(path=dirpath, mask=mask, proc_fun=self.__eventHandler,
+                                        rec=False, auto_add=qAutoAdd)
+                for name in filenames:
+                    fn = os.path.join(dirpath, name)
+                    try:
+                        if os.stat(fn).st_mtime < tSince: continue
+                    except FileNotFoundError:
+                        continue
+                    self.__event(tNow, fn, self.rescanMask)
+                    cnt += 1
+        logging.info("Rescan found %s files modified since %s", cnt, tSince)
+        return cnt
+
+    def __flush(self) -> None:
+        ''' Put a record on the queue for each pending path which has been quiet '''
+        pending = self.__pending
+        tQuiet = time.time() - self.__quietPeriod
+        while pending:
+            (fn, (t0, mask, t1, count)) = next(iter(pending.items()))
+            if t1 > tQuiet: break
+            del pending[fn]
+            self.__put(Coalesced(t0, fn, mask, t1, count), fn, mask)
+            logging.debug("Coalesced %s, %s events, %s", fn, count, self.__maskname(mask))
+
+    def __coalesce(self, t0:float, fn:str, mask:int, target:str) -> None:
+        '''
+        Merge the event into fn's pending record, or for a cancelling event drop the records
+        for target and below it, target being the file or the directory itself, and send
+        a record for the cancelling event right away
+        '''
+        pending = self.__pending
+        if mask & self.cancelMask:
+            prefix = target.rstrip(os.sep) + os.sep
+            for key in [key for key in pending if key == target or key.startswith(prefix)]:
+                del pending[key]
+            self.__put(Coalesced(t0, fn, mask, t0, 1), fn, mask)
+            return
+        item = pending.pop(fn, None) # Re-inserted at the end, newest
+        if item is None:
+            pending[fn] = [t0, mask, t0, 1]
+        else:
+            pending[fn] = [item[0], item[1] | mask, t0, item[3] + 1]
+
+    def __event(self, t0:float, fn:str, mask:int, target:str=None) -> None:
+        if self.__quietPeriod is None:
+            self.__put((t0, fn), fn, mask)
+        else:
+            self.__coalesce(t0, fn, mask, fn if target is None else target)
+
     def __eventHandler(self, e:pyinotify.Event) -> None:
         t0 = time.time() # Time of the event
+        self.__tLast = t0
+        if metrics.enabled: metrics.count("INotify " + e.maskname)
         fn = e.path if e.dir else os.path.join(e.path, e.name)
-        self.queue.put((t0, fn))
+        # For directories fn is the watched parent, so cancel by the directory's own path,
+        # otherwise removing d/sub would cancel everything pending below d
+        self.__event(t0, fn, e.mask, e.pathname if e.dir else fn)
         logging.debug("Event %s, %s", fn, e.maskname)
 
 if __name__ == "__main__":
     import Logger
+    import Metrics
+    import signal
+    import sys
 
     class Reader(Thread):
-        def __init__(self, args:ArgumentParser, q:queue.Queue) -> None:
-            Thread.__init__(self, "Reader", args)
+        def __init__(self, args:ArgumentParser, q:queue.Queue, name:str="Reader") -> None:
+            Thread.__init__(self, name, args)
             self.__queue = q
 
         def runIt(self) -> None:
             q = self.__queue
             while True:
-                (t0, fn) = q.get()
+                item = q.get()
+                self.mark()
+                if isinstance(q, BatchQueue):
+                    logging.info("Batch of %s, %s", len(item), item)
+                else:
+                    logging.info("%s", item)
                 q.task_done()
-                logging.info("%s %s", t0, fn)
 
     parser = ArgumentParser()
     Logger.addArgs(parser)
+    Metrics.addArgs(parser)
+    parser.add_argument("--quiet", type=float,
+            help="Seconds a file must be quiet before a coalesced event is sent")
+    parser.add_argument("--glob", type=str, action="append",
+            help="Subscribe a reader to the files matching this glob")
+    parser.add_argument("--maxQueue", type=int, help="Maximum events queued per reader")
+    parser.add_argument("--dropOldest", action="store_true",
+            help="Drop the oldest events when a queue is full instead of blocking")
+    parser.add_argument("--maxBatch", type=int, help="Maximum events per get")
+    parser.add_argument("--snapshot", type=str,
+            help="Snapshot file to report files which changed while not running")
+    parser.add_argument("--snapshotInterval", type=float,
+            help="Seconds between saves of the snapshot")
+    parser.add_argument("--scanWorkers", type=int, help="Threads to scan trees with")
     parser.add_argument("tgt", nargs="+", help="Directories to watch")
     args = parser.parse_args()
 
     Logger.mkLogger(args)
+    Metrics.setup(args) # Before the queues are made
 
-    i = INotify(args)
-    rdr = Reader(args, i.queue)
+    i = INotify(args, quietPeriod=args.quiet, maxQueue=args.maxQueue, maxBatch=args.maxBatch,
+                policy="dropOldest" if args.dropOldest else "block", snapshot=args.snapshot,
+                snapshotInterval=args.snapshotInterval)
+    if args.glob:
+        i.unsubscribe(i.queue)
+        readers = [Reader(args, i.subscribe(glob), glob) for glob in args.glob]
+    else:
+        readers = [Reader(args, i.queue)]
     i.start()
-    rdr.start()
-    for tgt in args.tgt: i.addTree(tgt)
+    for rdr in readers: rdr.start()
+    for tgt in args.tgt: i.addTree(tgt, workers=args.scanWorkers)
+
+    def onSIGTERM(signum:int, frame) -> None: # How systemd stops services
+        signal.signal(signum, signal.SIG_IGN) # Repeats, e.g. to the process group, would
+        sys.exit(128 + signum)                # interrupt saving the snapshot
 
+    signal.signal(signal.SIGTERM, onSIGTERM)
     try:
         Thread.waitForException()
+    except SystemExit:
+        raise
     except:
         logging.exception("Exception from INotify")
+    finally:
+        i.stop() # Saves the snapshot
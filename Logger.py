@@ -2,13 +2,361 @@
 #
 # Set up a logger. It can log to a console, file, and/or email.
 #
+# With --logQueue, the logging calls only put records on a bounded queue, and a single
+# listener thread formats them and does the file and SMTP I/O, so a slow disk or mail
+# server never stalls the logging threads.
+#
+# With --mailInterval or --mailMaxPerHour, errors are mailed as digests, with repeated
+# messages counted rather than repeated, over one reused SMTP connection.
+#
+# --logJSON writes JSON lines, and --logAge/--logCompress roll the logfile over by size
+# or age, compressing the backups in a background thread.
+#
 # June-2021, Pat Welch, pat@mousebrains.com
 
 from argparse import ArgumentParser
 import logging
 import logging.handlers
+from collections import OrderedDict, deque
+import datetime
+import threading
+import json
+import gzip
+import re
+import os
 import socket
 import getpass
+import atexit
+import queue
+import time
+import sys
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler for a bounded queue. When it is full, policy "block" waits for room,
+    "dropNew" drops the new record, and "dropOldest" drops the oldest waiting record.
+    The number dropped is kept in self.dropped.
+    '''
+    policies = ("block", "dropNew", "dropOldest")
+
+    def __init__(self, q:queue.Queue, policy:str="dropNew") -> None:
+        if policy not in self.policies:
+            raise ValueError(f"Unknown policy {policy}, should be one of {self.policies}")
+        logging.handlers.QueueHandler.__init__(self, q)
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        ''' Only merge the arguments into the message, the listener does the formatting '''
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record:logging.LogRecord) -> None:
+        if self.policy == "block":
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self.dropped += 1
+                if self.policy == "dropNew": return
+            try:
+                self.queue.get_nowait() # dropOldest
+            except queue.Empty:
+                pass
+
+class _QueueListener(logging.handlers.QueueListener):
+    ''' QueueListener reporting dropped records, whose stop waits for room in a full queue '''
+    def __init__(self, handler:DroppingQueueHandler, *handlers) -> None:
+        logging.handlers.QueueListener.__init__(self, handler.queue, *handlers,
+                                                respect_handler_level=True)
+        self.queueHandler = handler
+        self.reported = 0 # Dropped records already reported
+
+    def handle(self, record:logging.LogRecord) -> None: # Called in the listener's thread
+        self.reportDropped(record.name)
+        logging.handlers.QueueListener.handle(self, record)
+
+    def reportDropped(self, name:str) -> None:
+        dropped = self.queueHandler.dropped
+        if dropped == self.reported: return
+        logging.handlers.QueueListener.handle(self, logging.makeLogRecord(dict(
+            name=name, levelno=logging.WARNING, levelname="WARNING", threadName="Logger",
+            msg=f"Dropped {dropped - self.reported} log records, the log queue was full")))
+        self.reported = dropped
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+_listeners = {} # logger name -> _QueueListener
+
+def stopListener(name:str=None) -> None:
+    '''
+    Stop the listener thread for logger name after it has handled the queued records,
+    and remove its queue handler from the logger, so later records are not put on a queue
+    nobody reads. This is done at exit for every listener.
+    '''
+    listener = _listeners.pop(name, None)
+    if listener is None: return
+    logging.getLogger(name).removeHandler(listener.queueHandler)
+    listener.stop()
+    listener.reportDropped(name)
+    for ch in listener.handlers: ch.close()
+
+@atexit.register
+def _stopListeners() -> None:
+    for name in list(_listeners): stopListener(name)
+
+class DigestSMTPHandler(logging.Handler):
+    '''
+    Mail the records as one digest every interval seconds, identical messages once with
+    a count, and at most maxPerHour digests in any hour, the records meanwhile being
+    collected for the next one. One SMTP connection is kept open between digests, and
+    reopened if the server has closed it. close sends what is left regardless of the limit.
+    '''
+    def __init__(self, mailhost, fromaddr:str, toaddrs:list, subject:str,
+                 interval:float=60, maxPerHour:int=None, maxEntries:int=1000,
+                 timeout:float=30) -> None:
+        '''
+        mailhost: SMTP server name, or (name, port)
+        interval: seconds between digests
+        maxPerHour: most digests sent in an hour, None for no limit
+        maxEntries: different messages kept per digest, the rest are only counted
+        '''
+        logging.Handler.__init__(self)
+        (self.mailhost, self.mailport) = \
+                tuple(mailhost) if isinstance(mailhost, (list, tuple)) else (mailhost, 0)
+        self.fromaddr = fromaddr
+        self.toaddrs = [toaddrs] if isinstance(toaddrs, str) else list(toaddrs)
+        self.subject = subject
+        self.interval = interval
+        self.maxPerHour = maxPerHour
+        self.maxEntries = maxEntries
+        self.timeout = timeout
+        self.__entries = OrderedDict() # (levelname, message) -> [count, text, tFirst, tLast]
+        self.__skipped = 0 # Records not kept because of maxEntries
+        self.__sent = deque() # Times of the digests sent in the last hour
+        self.__sendLock = threading.Lock()
+        self.__smtp = None
+        self.__closing = threading.Event()
+        self.__thread = threading.Thread(target=self.__flusher, name="DigestSMTP", daemon=True)
+        self.__thread.start()
+
+    def emit(self, record:logging.LogRecord) -> None: # Called with self.lock held
+        try:
+            key = (record.levelname, record.getMessage())
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry[0] += 1
+                entry[3] = record.created
+            elif len(self.__entries) < self.maxEntries:
+                self.__entries[key] = [1, self.format(record), record.created, record.created]
+            else:
+                self.__skipped += 1
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        ''' Send a digest of what has been collected now, unless over maxPerHour '''
+        self.__flush(False)
+
+    def close(self) -> None:
+        self.__closing.set()
+        self.__flush(True)
+        with self.__sendLock:
+            if self.__smtp is not None:
+                try:
+                    self.__smtp.quit()
+                except Exception:
+                    pass
+                self.__smtp = None
+        logging.Handler.close(self)
+
+    def __flusher(self) -> None:
+        while not self.__closing.wait(self.__delay()):
+            self.flush()
+
+    def __delay(self) -> float:
+        ''' Seconds until the next digest, longer if maxPerHour have been sent '''
+        now = time.time()
+        while self.__sent and self.__sent[0] <= (now - 3600): self.__sent.popleft()
+        if self.maxPerHour is None or len(self.__sent) < self.maxPerHour: return self.interval
+        return max(self.interval, self.__sent[0] + 3600 - now)
+
+    def __flush(self, qForce:bool) -> None:
+        if not qForce and self.maxPerHour is not None:
+            self.__delay() # Forget digests more than an hour old
+            if len(self.__sent) >= self.maxPerHour: return
+        with self.lock:
+            if not self.__entries and not self.__skipped: return
+            (entries, skipped) = (self.__entries, self.__skipped)
+            self.__entries = OrderedDict()
+            self.__skipped = 0
+        n = sum(entry[0] for entry in entries.values()) + skipped
+        try:
+            self.__send(self.__digest(entries, skipped), n)
+        except Exception as e:
+            sys.stderr.write(f"Unable to mail a digest of {n} log records, {e!r}\n")
+
+    @staticmethod
+    def __digest(entries:OrderedDict, skipped:int) -> str:
+        fmt = lambda t: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        lines = []
+        for (count, text, tFirst, tLast) in entries.values():
+            if count > 1: lines.append(f"Repeated {count} times from {fmt(tFirst)} to {fmt(tLast)}")
+            lines.append(text)
+            lines.append("")
+        if skipped: lines.append(f"{skipped} more records with other messages were not kept")
+        return "\n".join(lines)
+
+    def __send(self, body:str, n:int) -> None:
+        import email.message # Only loaded when mailing
+        import email.utils
+        import smtplib
+        msg = email.message.EmailMessage()
+        msg["From"] = self.fromaddr
+        msg["To"] = ",".join(self.toaddrs)
+        msg["Subject"] = f"{self.subject}, {n} records"
+        msg["Date"] = email.utils.localtime()
+        msg.set_content(body)
+        with self.__sendLock:
+            if self.__smtp is not None:
+                try:
+                    if self.__smtp.noop()[0] != 250: raise smtplib.SMTPException("noop")
+                except Exception: # The server closed the connection
+                    self.__smtp.close()
+                    self.__smtp = None
+            if self.__smtp is None:
+                self.__smtp = smtplib.SMTP(self.mailhost, self.mailport, timeout=self.timeout)
+            self.__smtp.send_message(msg, self.fromaddr, self.toaddrs)
+            self.__sent.append(time.time())
+
+class JSONFormatter(logging.Formatter):
+    '''
+    One JSON object per line, with the record's epoch and ISO times, level, logger, thread,
+    message, any exception or stack, and any extra= fields
+    '''
+    __standard = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def formatTime(self, record:logging.LogRecord, datefmt:str=None) -> str:
+        t = datetime.datetime.fromtimestamp(record.created).astimezone()
+        return t.isoformat(timespec="milliseconds")
+
+    def format(self, record:logging.LogRecord) -> str:
+        info = dict(t=record.created, time=self.formatTime(record), level=record.levelname,
+                    logger=record.name, thread=record.threadName, message=record.getMessage())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text: info["exception"] = record.exc_text
+        if record.stack_info: info["stack"] = self.formatStack(record.stack_info)
+        for (key, val) in vars(record).items():
+            if key not in self.__standard: info[key] = val
+        return json.dumps(info, default=str)
+
+class CompressingRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    '''
+    Roll the logfile over once it reaches maxBytes, or at the next multiple of maxAge
+    seconds since the epoch, e.g. midnight UTC for a day. The file is renamed to
+    filename.YYYYmmddTHHMMSS and compressed, gzip or zstd, by a background thread,
+    so the logging thread only waits for the rename. backupCount backups are kept, 0 for all.
+    Backups left uncompressed by an earlier process are compressed on start.
+    '''
+    compressions = ("gzip", "zstd")
+
+    def __init__(self, filename:str, maxBytes:int=0, maxAge:float=None, backupCount:int=0,
+                 compression:str="gzip", encoding:str=None) -> None:
+        '''
+        maxBytes, maxAge: size in bytes and age in seconds to roll over at, 0/None for never
+        compression: "gzip", "zstd", which needs the zstandard package, or None for none
+        '''
+        if compression == "zstd":
+            import zstandard # Optional, only needed for zstd
+            self.__module = zstandard
+        elif compression == "gzip":
+            self.__module = gzip
+        elif compression is not None:
+            raise ValueError(f"Unknown compression {compression}, should be one of {self.compressions}")
+        logging.handlers.BaseRotatingHandler.__init__(self, filename, "a", encoding=encoding)
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.backupCount = backupCount
+        self.compression = compression
+        self.__suffix = {None: "", "gzip": ".gz", "zstd": ".zst"}[compression]
+        self.__backup = re.compile(re.escape(os.path.basename(self.baseFilename))
+                                   + r"[.](\d{8}T\d{6})(?:[.](\d+))?(?:[.]gz|[.]zst)?$")
+        t0 = os.stat(self.baseFilename).st_mtime if os.path.exists(self.baseFilename) else time.time()
+        self.__nextRollover(t0)
+        self.__queue = queue.Queue() # Backups to compress, None to stop
+        self.__thread = threading.Thread(target=self.__compressor, name="LogCompressor", daemon=True)
+        self.__thread.start()
+        for fn in self.__backups():
+            if compression is not None and not fn.endswith(self.__suffix): self.__queue.put(fn)
+        self.__queue.put(False) # Prune
+
+    def __nextRollover(self, t:float) -> None:
+        self.rolloverAt = None if not self.maxAge else ((t // self.maxAge) + 1) * self.maxAge
+
+    def shouldRollover(self, record:logging.LogRecord) -> bool:
+        if self.rolloverAt is not None and record.created >= self.rolloverAt: return True
+        if not self.maxBytes: return False
+        if self.stream is None: self.stream = self._open()
+        return self.stream.tell() >= self.maxBytes
+
+    def doRollover(self) -> None:
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        now = time.time()
+        dest = self.baseFilename + time.strftime(".%Y%m%dT%H%M%S", time.localtime(now))
+        n = 0
+        fn = dest
+        while os.path.exists(fn) or os.path.exists(fn + self.__suffix):
+            n += 1
+            fn = f"{dest}.{n}"
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, fn)
+            self.__queue.put(fn if self.compression is not None else False)
+        self.__nextRollover(now)
+        self.stream = self._open()
+
+    def close(self) -> None:
+        ''' Close the logfile and wait for the backups to be compressed '''
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+        logging.handlers.BaseRotatingHandler.close(self)
+
+    def __backups(self) -> list:
+        ''' Backup filenames, oldest first '''
+        dirName = os.path.dirname(self.baseFilename)
+        backups = []
+        for fn in os.listdir(dirName):
+            m = self.__backup.match(fn)
+            if m: backups.append((m[1], int(m[2] or 0), os.path.join(dirName, fn)))
+        return [item[2] for item in sorted(backups)]
+
+    def __compressor(self) -> None:
+        ''' Compress backups from the queue, and prune the oldest ones after each '''
+        while True:
+            fn = self.__queue.get()
+            if fn is None: return
+            try:
+                if fn: self.__compress(fn)
+                if self.backupCount:
+                    for old in self.__backups()[:-self.backupCount]: os.unlink(old)
+            except Exception as e:
+                sys.stderr.write(f"Unable to compress or prune log backup {fn}, {e!r}\n")
+
+    def __compress(self, fn:str) -> None:
+        import shutil
+        tmp = fn + self.__suffix + ".tmp"
+        with open(fn, "rb") as ifp, self.__module.open(tmp, "wb") as ofp:
+            shutil.copyfileobj(ifp, ofp, 1024 * 1024)
+        os.rename(tmp, fn + self.__suffix)
+        os.unlink(fn)
 
 # This is from MyLogger.py
 #
@@ -22,6 +370,11 @@ def addArgs(parser:ArgumentParser) -> None:
             help="Maximum logfile size in bytes")
     grp.add_argument("--logCount", type=int, default=3, metavar="count",
             help="Number of backup files to keep")
+    grp.add_argument("--logAge", type=float, metavar="seconds",
+            help="Also roll the logfile over at multiples of this many seconds")
+    grp.add_argument("--logCompress", type=str, choices=CompressingRotatingFileHandler.compressions,
+            help="Compress the logfile backups in a background thread")
+    grp.add_argument("--logJSON", action="store_true", help="Write the log as JSON lines")
     grp.add_argument("--mailTo", action="append", metavar="foo@bar.com",
             help="Where to mail errors and exceptions to")
     grp.add_argument("--mailFrom", type=str, metavar="foo@bar.com",
@@ -29,7 +382,16 @@ def addArgs(parser:ArgumentParser) -> None:
     grp.add_argument("--mailSubject", type=str, metavar="subject",
             help="Mail subject line")
     grp.add_argument("--smtpHost", type=str, default="localhost", metavar="foo.bar.com",
-            help="SMTP server to mail to")
+            help="SMTP server to mail to, optionally with :port")
+    grp.add_argument("--mailInterval", type=float, metavar="seconds",
+            help="Mail digests of the errors this often, 60 with only --mailMaxPerHour")
+    grp.add_argument("--mailMaxPerHour", type=int, metavar="count",
+            help="Most error digests to mail per hour")
+    grp.add_argument("--logQueue", type=int, metavar="length",
+            help="Log through a queue of this length, 0 for unbounded, and a listener thread")
+    grp.add_argument("--logPolicy", type=str, default="dropNew",
+            choices=DroppingQueueHandler.policies,
+            help="What to do with a record when the log queue is full")
     gg = grp.add_mutually_exclusive_group()
     gg.add_argument("--debug", action="store_true", help="Enable very verbose logging")
     gg.add_argument("--verbose", action="store_true", help="Enable verbose logging")
@@ -42,7 +404,9 @@ def mkLogger(args:ArgumentParser,
         ) -> logging.Logger:
     ''' Construct a logger and return it '''
     logger = logging.getLogger(name) # If name is None, then root logger
+    stopListener(name) # Stop any pre-existing listener for name
     logger.handlers.clear() # Clear any pre-existing handlers for name
+    handlers = []
 
     if fmt is None:
         if qThreaded:
@@ -50,7 +414,13 @@ def mkLogger(args:ArgumentParser,
         else:
             fmt = "%(asctime)s %(levelname)s: %(message)s"
 
-    if args.logfile:
+    if args.logfile and (getattr(args, "logAge", None) or getattr(args, "logCompress", None)):
+        ch = CompressingRotatingFileHandler(args.logfile,
+                maxBytes=args.logBytes,
+                maxAge=args.logAge,
+                backupCount=args.logCount,
+                compression=args.logCompress)
+    elif args.logfile:
         ch = logging.handlers.RotatingFileHandler(args.logfile,
                 maxBytes=args.logBytes,
                 backupCount=args.logCount)
@@ -65,9 +435,9 @@ def mkLogger(args:ArgumentParser,
     ch.setLevel(logLevel)
 
     formatter = logging.Formatter(fmt)
-    ch.setFormatter(formatter)
+    ch.setFormatter(JSONFormatter() if getattr(args, "logJSON", False) else formatter)
 
-    logger.addHandler(ch)
+    handlers.append(ch)
 
     if args.mailTo is not None:
         frm = args.mailFrom if args.mailFrom is not None else \
@@ -75,10 +445,31 @@ def mkLogger(args:ArgumentParser,
         subj = args.mailSubject if args.mailSubject is not None else \
                 ("Error on " + socket.getfqdn())
 
-        ch = logging.handlers.SMTPHandler(args.smtpHost, frm, args.mailTo, subj)
+        host = args.smtpHost
+        if ":" in host: # host:port
+            (smtpName, smtpPort) = host.rsplit(":", 1)
+            host = (smtpName, int(smtpPort))
+
+        interval = getattr(args, "mailInterval", None)
+        maxPerHour = getattr(args, "mailMaxPerHour", None)
+        if interval is None and maxPerHour is None:
+            ch = logging.handlers.SMTPHandler(host, frm, args.mailTo, subj)
+        else:
+            ch = DigestSMTPHandler(host, frm, args.mailTo, subj,
+                                   60 if interval is None else interval, maxPerHour)
         ch.setLevel(logging.ERROR)
         ch.setFormatter(formatter)
-        logger.addHandler(ch)
+        handlers.append(ch)
+
+    if getattr(args, "logQueue", None) is None:
+        for ch in handlers: logger.addHandler(ch)
+        return logger
+
+    ch = DroppingQueueHandler(queue.Queue(args.logQueue), args.logPolicy)
+    ch.setLevel(min(h.level for h in handlers))
+    logger.addHandler(ch)
+    listener = _listeners[name] = _QueueListener(ch, *handlers)
+    listener.start()
     return logger
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+#! /usr/bin/env python3
+#
+# Counters, high water marks, and timing histograms for the threads in a pipeline,
+# e.g. INotify -> queue -> consumer, which are logged periodically or on a signal.
+#
+# Everything is off until enabled, and instrumented code checks metrics.enabled
+# before doing any work, so the cost when disabled is one attribute lookup.
+
+from argparse import ArgumentParser
+import contextlib
+import threading
+import logging
+import signal
+import queue
+import json
+import math
+import time
+
+class Histogram:
+    ''' Counts of values in power of two buckets, from 1 microsecond up '''
+    nBuckets = 40 # Up to about 6 days
+
+    def __init__(self) -> None:
+        self.counts = [0] * self.nBuckets
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, dt:float) -> None:
+        us = dt * 1e6
+        index = 0 if us < 1 else min(self.nBuckets - 1, int(math.log2(us)) + 1)
+        self.counts[index] += 1
+        self.n += 1
+        self.total += dt
+        if dt > self.max: self.max = dt
+
+    def quantile(self, q:float) -> float:
+        ''' Upper edge, in seconds, of the bucket holding the q quantile '''
+        target = q * self.n
+        cnt = 0
+        for (index, n) in enumerate(self.counts):
+            cnt += n
+            if cnt >= target and n: return min(self.max, 2**index * 1e-6)
+        return self.max
+
+    def summary(self) -> dict:
+        if not self.n: return dict(n=0)
+        return dict(n=self.n, mean=self.total / self.n, p50=self.quantile(0.5),
+                    p90=self.quantile(0.9), p99=self.quantile(0.99), max=self.max)
+
+class Metrics:
+    ''' Thread safe named counters, high water marks, and histograms '''
+    def __init__(self) -> None:
+        self.enabled = False
+        self.__lock = threading.Lock()
+        self.__dumpEvent = threading.Event()
+        self.__thread = None
+        self.reset()
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__counters = {}
+            self.__highWater = {}
+            self.__histograms = {}
+            self.__t0 = time.time()
+
+    def count(self, name:str, n:int=1) -> None:
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + n
+
+    def highWater(self, name:str, value:float) -> None:
+        with self.__lock:
+            if value > self.__highWater.get(name, -math.inf): self.__highWater[name] = value
+
+    def observe(self, name:str, dt:float) -> None:
+        ''' Add the duration dt, in seconds, to the histogram name '''
+        with self.__lock:
+            hist = self.__histograms.get(name)
+            if hist is None: hist = self.__histograms[name] = Histogram()
+            hist.add(dt)
+
+    @contextlib.contextmanager
+    def timer(self, name:str):
+        ''' Time the body of a with statement into the histogram name '''
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def dump(self, qReset:bool=False) -> dict:
+        ''' Everything so far, with counters also as rates per second '''
+        with self.__lock:
+            dt = max(time.time() - self.__t0, 1e-9)
+            info = dict(
+                    seconds=dt,
+                    counters=dict(self.__counters),
+                    rates={key: val / dt for (key, val) in self.__counters.items()},
+                    highWater=dict(self.__highWater),
+                    histograms={key: hist.summary() for (key, hist) in self.__histograms.items()},
+                    )
+        if qReset: self.reset()
+        return info
+
+    def log(self, qReset:bool=False) -> None:
+        logging.info("Metrics %s", json.dumps(self.dump(qReset)))
+
+    def start(self, interval:float=None, sig:int=None, qReset:bool=True) -> None:
+        '''
+        Enable collection, and log the metrics every interval seconds and/or whenever
+        signal sig arrives. The logging is done by a daemon thread, not the signal handler.
+        '''
+        self.enabled = True
+        if interval is None and sig is None: return
+        if sig is not None: signal.signal(sig, lambda signum, frame: self.__dumpEvent.set())
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__dumper, args=(interval, qReset),
+                                             name="Metrics", daemon=True)
+            self.__thread.start()
+
+    def __dumper(self, interval:float, qReset:bool) -> None:
+        while True:
+            self.__dumpEvent.wait(interval)
+            self.__dumpEvent.clear()
+            self.log(qReset)
+
+metrics = Metrics() # The one everybody uses
+
+_nullTimer = contextlib.nullcontext()
+
+def timer(name:str):
+    ''' metrics.timer if enabled, otherwise a shared do nothing context '''
+    return metrics.timer(name) if metrics.enabled else _nullTimer
+
+class TimedQueue(queue.Queue):
+    ''' queue.Queue recording its depth high water mark and put to get latency '''
+    def __init__(self, name:str, maxsize:int=0) -> None:
+        self.name = name
+        queue.Queue.__init__(self, maxsize)
+
+    def _put(self, item) -> None: # Called with the queue's lock held
+        self.queue.append((time.monotonic(), item))
+        metrics.highWater(self.name + " depth", len(self.queue))
+
+    def _get(self): # Called with the queue's lock held
+        (t0, item) = self.queue.popleft()
+        metrics.observe(self.name + " latency", time.monotonic() - t0)
+        return item
+
+def addArgs(parser:ArgumentParser) -> None:
+    ''' Add command line arguments for metrics '''
+    grp = parser.add_argument_group("Metrics Related Options")
+    grp.add_argument("--metrics", action="store_true", help="Collect pipeline metrics")
+    grp.add_argument("--metricsInterval", type=float, metavar="seconds",
+            help="Log the metrics this often")
+    grp.add_argument("--metricsSignal", type=str, default="SIGUSR1", metavar="signal",
+            help="Log the metrics when this signal arrives")
+
+def setup(args:ArgumentParser) -> Metrics:
+    ''' Start collecting metrics if --metrics was given '''
+    if args.metrics:
+        metrics.start(args.metricsInterval,
+                      getattr(signal, args.metricsSignal) if args.metricsSignal else None)
+    return metrics
+
+if __name__ == "__main__":
+    import Logger
+
+    parser = ArgumentParser()
+    Logger.addArgs(parser)
+    addArgs(parser)
+    args = parser.parse_args()
+
+    Logger.mkLogger(args)
+    setup(args)
+
+    q = TimedQueue("demo")
+    for i in range(1000):
+        with timer("put"): q.put(i)
+        if i % 3: q.get()
+    metrics.log()
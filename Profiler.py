@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+#
+# Per thread profiling of Thread subclasses, switchable while running.
+#
+# "sample" mode periodically looks at every Thread's stack from a separate thread,
+# so the profiled threads run at full speed. "cprofile" mode runs cProfile in each
+# Thread, which must be started in the thread itself, so it is switched on or off
+# when the thread starts or calls Thread.mark. From Python 3.12, cProfile uses
+# sys.monitoring, which only one profiler may use at a time, so only the first Thread
+# to switch it on is profiled. Reports, with each thread's CPU time, are written to
+# files named after the thread and its native id when profiling stops.
+
+from argparse import ArgumentParser
+from collections import Counter
+import threading
+import logging
+import signal
+import time
+import sys
+import os
+
+def cpuTime(ident:int) -> float:
+    ''' CPU seconds used by the thread with ident, None if it is not available '''
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except Exception:
+        return None
+
+class _ThreadState:
+    ''' What is being collected for one thread '''
+    def __init__(self, thread:threading.Thread) -> None:
+        self.thread = thread
+        self.samples = Counter() # Collapsed stack -> count
+        self.profile = None # cProfile.Profile while enabled
+        self.generation = None # Profiler generation this state was set up for
+        self.cpu0 = None # CPU time when profiling started
+        self.t0 = None
+
+class Profiler:
+    '''
+    Profile Thread instances, in "sample" or "cprofile" mode, writing reports to directory
+    '''
+    modes = ("sample", "cprofile")
+
+    def __init__(self) -> None:
+        self.mode = None # None when off
+        self.directory = "."
+        self.interval = 0.005 # Seconds between samples
+        self.maxDepth = 64 # Stack frames kept per sample
+        self.generation = 0 # Incremented when the mode changes, checked by Thread.mark
+        self.__lastMode = "sample" # What toggle switches on
+        self.__lock = threading.Lock()
+        self.__states = {} # Thread ident -> _ThreadState
+        self.__sampler = None
+        self.__toggleEvent = threading.Event()
+        self.__qConfigured = False
+
+    def configure(self, args:ArgumentParser) -> None:
+        '''
+        Set up from addArgs's arguments, and install the toggle signal handler.
+        Called by the first Thread made with these arguments, later calls do nothing.
+        The toggling is done by a daemon thread, not the signal handler, since stopping
+        joins the sampler, writes reports, and logs.
+        '''
+        if self.__qConfigured: return
+        self.__qConfigured = True
+        self.directory = args.profileDir
+        self.interval = args.profileInterval
+        if args.profileSignal:
+            try:
+                signal.signal(getattr(signal, args.profileSignal),
+                              lambda signum, frame: self.__toggleEvent.set())
+                threading.Thread(target=self.__toggler, name="ProfilerToggle", daemon=True).start()
+            except ValueError: # Not the main thread
+                logging.warning("Unable to install the %s profiling toggle", args.profileSignal)
+        if args.profile: self.start(args.profile)
+
+    def start(self, mode:str="sample") -> None:
+        if mode not in self.modes:
+            raise ValueError(f"Unknown profiling mode {mode}, should be one of {self.modes}")
+        if self.mode == mode: return
+        if self.mode is not None: self.stop()
+        self.mode = self.__lastMode = mode
+        self.generation += 1
+        with self.__lock:
+            for state in self.__states.values(): self.__begin(state)
+        if mode == "sample" and self.__sampler is None:
+            self.__sampler = threading.Thread(target=self.__sample, name="Profiler", daemon=True)
+            self.__sampler.start()
+        logging.info("Started %s profiling", mode)
+
+    def stop(self) -> None:
+        ''' Stop profiling, sampling reports are written now, cprofile ones by each thread '''
+        if self.mode is None: return
+        self.mode = None
+        self.generation += 1
+        if self.__sampler is not None: # It writes the reports as it exits
+            if self.__sampler is not threading.current_thread(): self.__sampler.join()
+            self.__sampler = None
+        logging.info("Stopped profiling")
+
+    def __toggler(self) -> None:
+        while True:
+            self.__toggleEvent.wait()
+            self.__toggleEvent.clear()
+            self.toggle()
+
+    def toggle(self) -> None:
+        if self.mode is None:
+            self.start(self.__lastMode)
+        else:
+            self.stop()
+
+    def __begin(self, state:_ThreadState) -> None:
+        state.samples.clear()
+        state.t0 = time.time()
+        state.cpu0 = cpuTime(state.thread.ident)
+
+    def threadStarted(self, thread:threading.Thread) -> None:
+        ''' Called by Thread.run in the new thread before runIt '''
+        state = _ThreadState(thread)
+        self.__begin(state)
+        with self.__lock: self.__states[thread.ident] = state
+        self.checkpoint(thread)
+
+    def threadStopped(self, thread:threading.Thread) -> None:
+        ''' Called by Thread.run in the thread after runIt returns or raises '''
+        with self.__lock: state = self.__states.pop(thread.ident, None)
+        if state is None: return
+        if state.profile is not None:
+            state.profile.disable()
+            self.__write(state)
+        elif state.samples:
+            self.__write(state)
+
+    def checkpoint(self, thread:threading.Thread) -> None:
+        ''' Switch cProfile on or off in the calling thread if the mode has changed '''
+        state = self.__states.get(thread.ident)
+        if state is None or state.generation == self.generation: return
+        state.generation = self.generation
+        if self.mode == "cprofile" and state.profile is None:
+            self.__begin(state)
+            import cProfile # Only loaded when used
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                state.profile = profile
+            except ValueError as e: # 3.12+, another profiling tool is already active
+                logging.warning("Unable to cProfile %s, %s", thread.name, e)
+        elif self.mode != "cprofile" and state.profile is not None:
+            state.profile.disable()
+            self.__write(state)
+            state.profile = None
+
+    def __sample(self) -> None:
+        ''' Sampling thread, counts the collapsed stack of every Thread each interval '''
+        while self.mode == "sample":
+            frames = sys._current_frames()
+            with self.__lock:
+                for (ident, state) in self.__states.items():
+                    frame = frames.get(ident)
+                    if frame is not None: state.samples[self.__collapse(frame)] += 1
+            time.sleep(self.interval)
+        with self.__lock: states = list(self.__states.values())
+        for state in states:
+            self.__write(state)
+            state.samples.clear()
+
+    def __collapse(self, frame) -> str:
+        ''' "outer;...;inner" function names of frame's stack '''
+        names = []
+        while frame is not None and len(names) < self.maxDepth:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def __write(self, state:_ThreadState) -> None:
+        ''' Write the report for state to directory/name.id.mode.txt '''
+        name = state.thread.name
+        tid = state.thread.native_id # Replicas may share a name
+        mode = "cprofile" if state.profile is not None else "sample"
+        cpu = cpuTime(state.thread.ident)
+        cpu = None if cpu is None or state.cpu0 is None else (cpu - state.cpu0)
+        wall = time.time() - state.t0
+        os.makedirs(self.directory, exist_ok=True)
+        fn = os.path.join(self.directory, f"{name}.{tid}.{mode}.txt")
+        try:
+            with open(fn, "w") as fp:
+                fp.write(f"Thread {name}, {mode}, {wall:.3f} wall seconds, {cpu} CPU seconds\n\n")
+                if state.profile is not None:
+                    state.profile.dump_stats(fn[:-4] + ".prof")
+                    import pstats
+                    stats = pstats.Stats(state.profile, stream=fp)
+                    stats.sort_stats("cumulative").print_stats(50)
+                else:
+                    self.__writeSamples(state.samples, fp)
+                    with open(fn[:-4] + ".collapsed", "w") as cp: # For flame graphs
+                        for (stack, n) in state.samples.items(): cp.write(f"{stack} {n}\n")
+            logging.info("Wrote %s profile of %s to %s", mode, name, fn)
+        except Exception:
+            logging.exception("Unable to write profile of %s to %s", name, fn)
+
+    @staticmethod
+    def __writeSamples(samples:Counter, fp) -> None:
+        total = sum(samples.values())
+        fp.write(f"{total} samples\n\nInnermost functions\n")
+        leaves = Counter()
+        for (stack, n) in samples.items(): leaves[stack.rsplit(";", 1)[-1]] += n
+        for (leaf, n) in leaves.most_common(30):
+            fp.write(f"{100 * n / total:6.2f}% {n:8d} {leaf}\n")
+        fp.write("\nStacks\n")
+        for (stack, n) in samples.most_common(20):
+            fp.write(f"{100 * n / total:6.2f}% {n:8d} {stack}\n")
+
+profiler = Profiler() # The one every Thread uses
+
+def addArgs(parser:ArgumentParser) -> None:
+    ''' Add command line arguments for profiling '''
+    grp = parser.add_argument_group("Profiling Related Options")
+    grp.add_argument("--profile", type=str, choices=Profiler.modes,
+            help="Profile every Thread from the start")
+    grp.add_argument("--profileDir", type=str, default=".", metavar="directory",
+            help="Where to write the per thread reports")
+    grp.add_argument("--profileInterval", type=float, default=0.005, metavar="seconds",
+            help="Time between samples in sample mode")
+    grp.add_argument("--profileSignal", type=str, default="SIGUSR2", metavar="signal",
+            help="Signal which switches profiling on and off")
+
+if __name__ == "__main__":
+    import Logger
+    from Thread import Thread
+
+    class Busy(Thread):
+        def __init__(self, args:ArgumentParser, name:str) -> None:
+            Thread.__init__(self, name, args)
+
+        def runIt(self) -> None:
+            for i in range(self.args.n):
+                self.mark()
+                sum(j * j for j in range(100000))
+
+    parser = ArgumentParser()
+    Logger.addArgs(parser)
+    addArgs(parser)
+    parser.add_argument("--n", type=int, default=50, help="Iterations per thread")
+    args = parser.parse_args()
+
+    Logger.mkLogger(args)
+
+    thrds = [Busy(args, f"Busy{i}") for i in range(2)]
+    for thrd in thrds: thrd.start()
+    for thrd in thrds: thrd.join()
+    profiler.stop()
@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+#
+# Spatial index of lon/lat points for radius and bounding box queries
+#
+# Points are bucketed by their earth centered, earth fixed, coordinates on the WGS-84
+# ellipsoid. The straight line chord between two points is never longer than the
+# geodesic between them, so the chord is a conservative bound to prune candidates,
+# which are then refined with Vincenty's method from GreatCircle.
+
+import numpy as np
+import logging
+try:
+    from .GreatCircle import greatCircle, Units, rMajor, flattening # As a module
+except:
+    from GreatCircle import greatCircle, Units, rMajor, flattening # From within module
+
+def ecef(lon:np.array, lat:np.array) -> np.array:
+    ''' Earth centered, earth fixed, coordinates in meters, N by 3, on the WGS-84 ellipsoid '''
+    lon = np.deg2rad(np.asarray(lon, dtype=float).reshape(-1))
+    lat = np.deg2rad(np.asarray(lat, dtype=float).reshape(-1))
+    e2 = flattening * (2 - flattening) # First eccentricity squared
+    sinLat = np.sin(lat)
+    cosLat = np.cos(lat)
+    N = rMajor / np.sqrt(1 - e2 * sinLat**2) # Prime vertical radius of curvature
+    xyz = np.empty((lon.size, 3))
+    xyz[:,0] = N * cosLat * np.cos(lon)
+    xyz[:,1] = N * cosLat * np.sin(lon)
+    xyz[:,2] = N * (1 - e2) * sinLat
+    return xyz
+
+class SpatialIndex:
+    '''
+    Bucket index of points on the ellipsoid
+
+    Points are kept in a main set sorted by cell key and a small pending set of recent
+    insertions, which is searched by brute force until it is merged into the main set.
+    '''
+    def __init__(self, cellSize:float=100e3) -> None:
+        '''
+        cellSize: edge length in meters of the ECEF grid cells points are bucketed into,
+                  at least minCellSize so the packed cell keys fit in an int64
+        '''
+        self.cellSize = float(cellSize)
+        if not (self.cellSize >= self.minCellSize()): # Also catches NaN
+            raise ValueError(f"cellSize {cellSize} is less than {self.minCellSize()} meters, "
+                             + "the smallest whose cell keys fit in an int64")
+        self.__nCells = self.__cellsPerAxis(self.cellSize)
+        self.__lon = np.empty(0) # Main set, sorted by key
+        self.__lat = np.empty(0)
+        self.__ids = np.empty(0, dtype=int)
+        self.__xyz = np.empty((0, 3))
+        self.__keys = np.empty(0, dtype=np.int64)
+        self.__pending = [] # (lon, lat, ids, xyz) tuples not yet merged
+        self.__nPending = 0
+        self.__nextID = 0
+
+    @staticmethod
+    def __cellsPerAxis(cellSize:float) -> int:
+        return 2 * int(np.ceil(rMajor / cellSize)) + 3
+
+    @classmethod
+    def minCellSize(cls) -> float:
+        ''' Smallest cellSize, in meters, whose packed keys, nCells**3, fit in an int64 '''
+        nMax = int(np.floor(float(np.iinfo(np.int64).max) ** (1/3))) - 1
+        cellSize = 2 * rMajor / (nMax - 5)
+        while cls.__cellsPerAxis(cellSize) ** 3 > np.iinfo(np.int64).max: cellSize *= 1.001
+        return cellSize
+
+    def __repr__(self) -> str:
+        return f"SpatialIndex({len(self)} points, {self.cellSize} m cells)"
+
+    def __len__(self) -> int:
+        return self.__lon.size + self.__nPending
+
+    def __cells(self, xyz:np.array) -> np.array:
+        ''' Integer cell indices per axis for ECEF coordinates '''
+        return np.floor(xyz / self.cellSize).astype(np.int64) + self.__nCells // 2
+
+    def __key(self, cells:np.array) -> np.array:
+        ''' Pack per axis cell indices into one integer key '''
+        n = self.__nCells
+        return (cells[...,0] * n + cells[...,1]) * n + cells[...,2]
+
+    def insert(self, lon:np.array, lat:np.array, ids:np.array=None) -> np.array:
+        '''
+        Add points to the index and return their ids
+
+        ids: optional integer identifiers, by default sequential numbers are assigned
+        '''
+        (lon, lat) = np.broadcast_arrays(np.asarray(lon, dtype=float),
+                                         np.asarray(lat, dtype=float))
+        lon = lon.reshape(-1).copy()
+        lat = lat.reshape(-1).copy()
+        if ids is None:
+            ids = np.arange(self.__nextID, self.__nextID + lon.size)
+        else:
+            ids = np.asarray(ids, dtype=int).reshape(-1)
+            if ids.size != lon.size:
+                raise ValueError(f"{ids.size} ids for {lon.size} points")
+        if ids.size: self.__nextID = max(self.__nextID, int(ids.max()) + 1)
+        self.__pending.append((lon, lat, ids, ecef(lon, lat))) # ECEF computed once
+        self.__nPending += lon.size
+        if self.__nPending > max(1024, self.__lon.size // 8): self.merge()
+        return ids
+
+    def merge(self) -> None:
+        ''' Merge the pending insertions into the sorted main set '''
+        if not self.__pending: return
+        lon = np.concatenate([self.__lon] + [item[0] for item in self.__pending])
+        lat = np.concatenate([self.__lat] + [item[1] for item in self.__pending])
+        ids = np.concatenate([self.__ids] + [item[2] for item in self.__pending])
+        xyz = np.concatenate([self.__xyz] + [item[3] for item in self.__pending])
+        keys = self.__key(self.__cells(xyz))
+        order = np.argsort(keys, kind="stable")
+        (self.__lon, self.__lat, self.__ids, self.__xyz, self.__keys) = \
+                (lon[order], lat[order], ids[order], xyz[order], keys[order])
+        self.__pending = []
+        self.__nPending = 0
+
+    def __candidates(self, xyz:np.array, radius:float) -> np.array:
+        ''' Indices into the main set of points whose chord to xyz is within radius '''
+        keys = self.__keys
+        if not keys.size: return np.empty(0, dtype=int)
+        lo = np.clip(self.__cells(xyz - radius), 0, self.__nCells - 1)
+        hi = np.clip(self.__cells(xyz + radius), 0, self.__nCells - 1)
+        nCells = np.prod(hi - lo + 1)
+        if nCells > keys.size: # Cheaper to check every point
+            index = np.arange(keys.size)
+        else:
+            # Each (x, y) column of cells is a contiguous run of keys in z
+            (ix, iy) = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1),
+                                   indexing="ij")
+            base = (ix.reshape(-1) * self.__nCells + iy.reshape(-1)) * self.__nCells
+            i0 = np.searchsorted(keys, base + lo[2], side="left")
+            i1 = np.searchsorted(keys, base + hi[2], side="right")
+            q = i1 > i0
+            if not q.any(): return np.empty(0, dtype=int)
+            index = np.concatenate([np.arange(a, b) for (a, b) in zip(i0[q], i1[q])])
+        chord2 = ((self.__xyz[index] - xyz)**2).sum(axis=1)
+        return index[chord2 <= radius**2]
+
+    def within(self, lon:float, lat:float, radius:float,
+               units:Units=Units.Meters) -> tuple:
+        '''
+        Points within radius, in units, of (lon, lat)
+
+        Returns (ids, distances) sorted by distance, with distances in units
+        '''
+        meters = radius / units
+        xyz = ecef(lon, lat)[0]
+        index = self.__candidates(xyz, meters)
+        (lon0, lat0, ids) = (self.__lon[index], self.__lat[index], self.__ids[index])
+        if self.__nPending: # Brute force the pending points
+            pLon = np.concatenate([item[0] for item in self.__pending])
+            pLat = np.concatenate([item[1] for item in self.__pending])
+            pIDs = np.concatenate([item[2] for item in self.__pending])
+            pXYZ = np.concatenate([item[3] for item in self.__pending])
+            q = ((pXYZ - xyz)**2).sum(axis=1) <= meters**2
+            lon0 = np.concatenate((lon0, pLon[q]))
+            lat0 = np.concatenate((lat0, pLat[q]))
+            ids = np.concatenate((ids, pIDs[q]))
+        if not ids.size: return (ids, np.empty(0))
+        dist = greatCircle(lon, lat, lon0, lat0, units=units) # Exact refine step
+        q = dist <= radius
+        order = np.argsort(dist[q], kind="stable")
+        logging.debug("within %s %s %s, %s candidates, %s found",
+                      lon, lat, radius, ids.size, q.sum())
+        return (ids[q][order], dist[q][order])
+
+    def boundingBox(self, lonMin:float, lonMax:float, latMin:float, latMax:float) -> np.array:
+        '''
+        ids of points inside a lon/lat box, lonMin > lonMax wraps across the dateline
+        '''
+        self.merge()
+        lon = np.remainder(self.__lon - lonMin, 360) # Degrees east of lonMin
+        width = lonMax - lonMin if lonMax >= lonMin else lonMax - lonMin + 360
+        q = np.logical_and(lon <= width, np.logical_and(self.__lat >= latMin, self.__lat <= latMax))
+        return self.__ids[q]
+
+    def save(self, fn:str) -> None:
+        ''' Save to an npz file, including the sorted keys so load does not rebuild them '''
+        self.merge()
+        np.savez(fn, cellSize=self.cellSize, nextID=self.__nextID,
+                 lon=self.__lon, lat=self.__lat, ids=self.__ids,
+                 xyz=self.__xyz, keys=self.__keys)
+
+    @classmethod
+    def load(cls, fn:str) -> "SpatialIndex":
+        ''' Load an index written by save '''
+        with np.load(fn) as data:
+            index = cls(float(data["cellSize"]))
+            index.__nextID = int(data["nextID"])
+            index.__lon = data["lon"]
+            index.__lat = data["lat"]
+            index.__ids = data["ids"]
+            index.__xyz = data["xyz"]
+            index.__keys = data["keys"]
+        return index
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import time
+
+    parser = ArgumentParser()
+    parser.add_argument("--n", type=int, default=1000000, help="Number of random points")
+    parser.add_argument("--radius", type=float, default=100, help="Query radius in km")
+    parser.add_argument("--cellSize", type=float, default=100, help="Cell size in km")
+    parser.add_argument("--npz", type=str, help="Save to and reload from this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    lon = rng.uniform(-180, 180, args.n)
+    lat = np.rad2deg(np.arcsin(rng.uniform(-1, 1, args.n))) # Uniform on the sphere
+
+    t0 = time.time()
+    index = SpatialIndex(args.cellSize * 1000)
+    index.insert(lon, lat)
+    index.merge()
+    print(index, "built in", time.time() - t0, "seconds")
+
+    if args.npz:
+        index.save(args.npz)
+        t0 = time.time()
+        index = SpatialIndex.load(args.npz)
+        print(index, "loaded in", time.time() - t0, "seconds")
+
+    for (lon0, lat0) in ((0, 0), (-124.5, 44.6), (179.9, -60), (10, 89.9)):
+        t0 = time.time()
+        (ids, dist) = index.within(lon0, lat0, args.radius, Units.Kilometers)
+        dt = time.time() - t0
+        brute = (greatCircle(lon0, lat0, lon, lat, Units.Kilometers) <= args.radius).sum()
+        print(f"({lon0}, {lat0}) {ids.size} found, brute force {brute}, {dt:.4f} seconds")
@@ -4,11 +4,23 @@
 # The actual thread run method is called runIt, otherwise it is like a normal
 # thread class.
 #
+# A Supervisor runs replicas of a Thread, restarting them with a backoff when they fail,
+# and asks them to stop cooperatively through a stop event.
+#
 # June-2021, Pat Welch, pat@mousebrains.com
 
 from argparse import ArgumentParser
 import threading
+import logging
+import heapq
 import queue
+import time
+try:
+    from .Metrics import metrics, timer # As a module
+    from .Profiler import profiler
+except:
+    from Metrics import metrics, timer # From within module
+    from Profiler import profiler
 #
 # Base class for threading which catches exceptions and sends them to a queue
 #
@@ -24,17 +36,65 @@ class Thread(threading.Thread):
     def __init__(self, name:str, args:ArgumentParser=None) -> None:
         '''
         name: is the name of the thread saved in self.name and used by logging messages
-        args: is saved in self.args
+        args: is saved in self.args, if it has Profiler.addArgs's options they set up
+              profiling of every Thread
         '''
         threading.Thread.__init__(self, daemon=True)
         self.name = name
         self.args = args
+        self.__tMark = None
+        self.stopEvent = threading.Event() # Set to ask runIt to finish, see stopping
+        self.supervisor = None # Set by a Supervisor, which is told how runIt ended
+        if hasattr(args, "profileDir"): profiler.configure(args)
 
     def run(self) -> None: # Called on thread start
         try:
+            profiler.threadStarted(self)
             self.runIt() # Call the actual class's run function inside a try stanza
+            if self.supervisor is not None: self.supervisor.finished(self, None)
         except Exception as e:
-            self.__queue.put(e)
+            if metrics.enabled: metrics.count(self.name + " exceptions")
+            if self.supervisor is not None:
+                self.supervisor.finished(self, e)
+            else:
+                self.__queue.put(e)
+        finally:
+            profiler.threadStopped(self)
+
+    def stop(self) -> None:
+        ''' Ask runIt to finish, it has to check stopping '''
+        self.stopEvent.set()
+
+    def stopping(self, timeout:float=None) -> bool:
+        '''
+        True if asked to stop. With a timeout, wait up to that long for it, so a runIt
+        loop can use it in place of time.sleep, or between queue gets to drain them.
+        '''
+        if timeout is None: return self.stopEvent.is_set()
+        return self.stopEvent.wait(timeout)
+
+    def timed(self, label:str="iteration"):
+        '''
+        Context manager timing its body into the "name label" histogram when metrics
+        are enabled, e.g. "with self.timed(): ..." around the work in a runIt loop
+        '''
+        return timer(self.name + " " + label)
+
+    def mark(self, label:str="iteration") -> None:
+        '''
+        Record the time since the previous mark, call once per runIt loop iteration.
+        This is also where cProfile profiling is switched on or off while running.
+        '''
+        profiler.checkpoint(self)
+        if not metrics.enabled: return
+        t = time.perf_counter()
+        if self.__tMark is not None: metrics.observe(self.name + " " + label, t - self.__tMark)
+        self.__tMark = t
+
+    @classmethod
+    def putException(cls, e:Exception) -> None:
+        ''' Send e to waitForException, for exceptions raised outside of runIt '''
+        cls.__queue.put(e)
 
     @classmethod
     def isQueueEmpty(cls) -> bool: 
@@ -53,8 +113,111 @@ class Thread(threading.Thread):
         except Exception as e:
             raise e
 
+class Supervisor(Thread):
+    '''
+    Run replicas of a Thread made by factory(replica), and restart each one when its
+    runIt raises, after a backoff which doubles with each consecutive failure. A replica
+    which ran for at least resetAfter seconds is not counted as consecutive. If a replica
+    fails more than maxRestarts times in a row, its exception is sent on to
+    Thread.waitForException, as for an unsupervised Thread.
+    '''
+    def __init__(self, args:ArgumentParser, factory, replicas:int=1, name:str="Supervisor",
+                 backoff:float=0.1, maxBackoff:float=60, maxRestarts:int=None,
+                 resetAfter:float=60, qRestartOnReturn:bool=False) -> None:
+        '''
+        factory: function of the replica number returning a new, not started, Thread
+        replicas: number of copies to run
+        backoff, maxBackoff: first and longest delay in seconds before a restart
+        maxRestarts: consecutive failures before giving up, None for never
+        resetAfter: seconds a replica must run for its failure count to be reset
+        qRestartOnReturn: also restart replicas whose runIt returns without stop
+        '''
+        Thread.__init__(self, name, args)
+        self.__factory = factory
+        self.__replicas = replicas
+        self.__backoff = backoff
+        self.__maxBackoff = maxBackoff
+        self.__maxRestarts = maxRestarts
+        self.__resetAfter = resetAfter
+        self.__qRestartOnReturn = qRestartOnReturn
+        self.__events = queue.Queue() # (thread, exception) as replicas finish
+        self.__lock = threading.Lock()
+        self.workers = {} # replica -> running Thread
+        self.__started = {} # replica -> start time
+        self.__failures = {} # replica -> consecutive failures
+        self.restarts = 0
+
+    def __launch(self, replica:int) -> None:
+        thrd = self.__factory(replica)
+        thrd.supervisor = self
+        thrd.replica = replica
+        with self.__lock: # So stop either sees this replica or it is never started
+            if self.stopping(): return
+            self.workers[replica] = thrd
+            self.__started[replica] = time.time()
+            thrd.start()
+
+    def finished(self, thrd:Thread, e:Exception) -> None:
+        ''' Called in a replica's thread when its runIt ends, e is None if it returned '''
+        self.__events.put((thrd, e))
+
+    def runIt(self) -> None: # Called on thread start
+        for replica in range(self.__replicas): self.__launch(replica)
+        pending = [] # heap of (time, replica) to restart
+        while not self.stopping():
+            timeout = None if not pending else max(0, pending[0][0] - time.time())
+            try:
+                (thrd, e) = self.__events.get(timeout=timeout)
+                self.__finished(thrd, e, pending)
+            except queue.Empty:
+                pass
+            while pending and pending[0][0] <= time.time() and not self.stopping():
+                (t, replica) = heapq.heappop(pending)
+                logging.info("Restarting %s replica %s", self.name, replica)
+                self.restarts += 1
+                self.__launch(replica)
+
+    def __finished(self, thrd:Thread, e:Exception, pending:list) -> None:
+        if thrd is None: return # Woken up by stop
+        replica = thrd.replica
+        with self.__lock:
+            if self.workers.get(replica) is thrd: del self.workers[replica]
+        if self.stopping() or thrd.stopping(): return # Asked to stop
+        if e is None and not self.__qRestartOnReturn:
+            logging.info("%s finished", thrd.name)
+            return
+        if time.time() - self.__started[replica] >= self.__resetAfter:
+            self.__failures[replica] = 0
+        n = self.__failures.get(replica, 0)
+        if e is not None and self.__maxRestarts is not None and n >= self.__maxRestarts:
+            logging.error("%s failed %s times in a row, giving up", thrd.name, n + 1)
+            self.putException(e)
+            return
+        self.__failures[replica] = n + 1
+        dt = min(self.__maxBackoff, self.__backoff * 2**n)
+        logging.warning("%s %s, restarting in %s seconds", thrd.name,
+                        "returned" if e is None else f"failed, {e!r}", dt)
+        heapq.heappush(pending, (time.time() + dt, replica))
+
+    def stop(self, timeout:float=None) -> bool:
+        '''
+        Ask the replicas to stop, and wait up to timeout seconds for them to finish,
+        e.g. drain their queues. Returns True if they all did.
+        '''
+        self.stopEvent.set()
+        self.__events.put((None, None)) # Wake up runIt
+        with self.__lock: workers = list(self.workers.values())
+        for thrd in workers: thrd.stop()
+        tEnd = None if timeout is None else (time.time() + timeout)
+        for thrd in workers:
+            thrd.join(None if tEnd is None else max(0, tEnd - time.time()))
+        qAll = not any(thrd.is_alive() for thrd in workers)
+        if not qAll: logging.warning("Not every replica of %s stopped", self.name)
+        return qAll
+
 if __name__ == "__main__":
     import Logger
+    import Profiler
     import logging
     import time
 
@@ -76,6 +239,7 @@ if __name__ == "__main__":
 
     parser = ArgumentParser()
     Logger.addArgs(parser)
+    Profiler.addArgs(parser)
     A.addArgs(parser)
     args = parser.parse_args()
 
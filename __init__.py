@@ -0,0 +1,58 @@
+#
+# A collection of Python 3 utilities, see README.md
+#
+# Nothing is imported until it is used, PEP 562, so importing the package, or one of
+# its light modules, does not pull in numpy, pyinotify, yaml, or psycopg.
+
+import importlib
+
+_modules = (
+        "AsyncINotify",
+        "Credentials",
+        "Dispatcher",
+        "GreatCircle",
+        "INotify",
+        "Logger",
+        "Metrics",
+        "Profiler",
+        "SingleInstance",
+        "SpatialIndex",
+        "Thread",
+        "loadAndExecuteSQL",
+        )
+
+_attributes = { # Names, other than the modules', and the module they are defined in
+        "mkLogger": "Logger",
+        "Supervisor": "Thread",
+        "metrics": "Metrics",
+        "TimedQueue": "Metrics",
+        "profiler": "Profiler",
+        "BatchQueue": "INotify",
+        "Coalesced": "INotify",
+        "walkTree": "INotify",
+        "getCredentials": "Credentials",
+        "greatCircle": "GreatCircle",
+        "pairwise": "GreatCircle",
+        "nearest": "GreatCircle",
+        "within": "GreatCircle",
+        "trackDistance": "GreatCircle",
+        "cumulativeDistance": "GreatCircle",
+        "LocalProjection": "GreatCircle",
+        "Units": "GreatCircle",
+        "Method": "GreatCircle",
+        }
+
+__all__ = sorted(_modules + tuple(_attributes))
+
+def __getattr__(name:str):
+    ''' Import a module, or the module a name is defined in, on first use '''
+    if name in _modules:
+        return importlib.import_module("." + name, __name__)
+    if name in _attributes:
+        value = getattr(importlib.import_module("." + _attributes[name], __name__), name)
+        globals()[name] = value # Found directly from now on
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+#
+# Benchmark the speed, peak memory, and accuracy of GreatCircle.greatCircle
+#
+# Synthetic pairs are generated the same way distanceSample.m does, so no Matlab is needed.
+# Errors are measured against a reference which does not use greatCircle, Karney's method
+# from geographiclib if it is installed, otherwise a scalar Vincenty written with math,
+# or against the Matlab distances in distance.sample.nc with --nc. Results are written as
+# JSON lines, and --baseline compares them against an earlier run to catch regressions
+# between releases.
+
+from argparse import ArgumentParser
+import numpy as np
+import tracemalloc
+import platform
+import logging
+import math
+import json
+import time
+import sys
+try:
+    from .GreatCircle import greatCircle, Units, Method, closedFormLimit # As a module
+except:
+    from GreatCircle import greatCircle, Units, Method, closedFormLimit # From within module
+
+def wrapTo180(x:np.array) -> np.array:
+    ''' Matlab's wrapTo180 '''
+    return np.remainder(x + 180, 360) - 180
+
+def mkSample(n:int, seed:int=None, dtype:str="float64") -> tuple:
+    ''' n random (lon0, lat0, lon1, lat1) pairs, as distanceSample.m makes them '''
+    rng = np.random.default_rng(seed)
+    lat0 = wrapTo180(rng.random(n) * 360) / 2
+    lat1 = wrapTo180(rng.random(n) * 360) / 2
+    lon0 = wrapTo180(rng.random(n) * 360)
+    lon1 = wrapTo180(rng.random(n) * 360)
+    return tuple(x.astype(dtype) for x in (lon0, lat0, lon1, lat1))
+
+def loadSample(fn:str) -> tuple:
+    ''' (lon0, lat0, lon1, lat1, dist) from distance.sample.nc '''
+    import xarray as xr
+    with xr.open_dataset(fn) as ds:
+        return tuple(ds[key].values for key in ("lon0", "lat0", "lon1", "lat1", "dist"))
+
+def vincenty(lon0:float, lat0:float, lon1:float, lat1:float, criteria:float=1e-15,
+             maxIterations:int=1000) -> float:
+    '''
+    WGS-84 distance in meters by Vincenty's inverse method, one pair at a time with math,
+    written independently of greatCircle so it can check it. NaN if it does not converge.
+    '''
+    a = 6378137.
+    f = 1 / 298.257223563
+    b = (1 - f) * a
+    U0 = math.atan((1 - f) * math.tan(math.radians(lat0)))
+    U1 = math.atan((1 - f) * math.tan(math.radians(lat1)))
+    (sinU0, cosU0, sinU1, cosU1) = (math.sin(U0), math.cos(U0), math.sin(U1), math.cos(U1))
+    L = math.radians(lon1 - lon0)
+    lam = L
+    for i in range(maxIterations):
+        (sinLam, cosLam) = (math.sin(lam), math.cos(lam))
+        sinSigma = math.hypot(cosU1 * sinLam, cosU0 * sinU1 - sinU0 * cosU1 * cosLam)
+        if sinSigma == 0: return 0. # Coincident points
+        cosSigma = sinU0 * sinU1 + cosU0 * cosU1 * cosLam
+        sigma = math.atan2(sinSigma, cosSigma)
+        sinAlpha = cosU0 * cosU1 * sinLam / sinSigma
+        cosAlpha2 = 1 - sinAlpha**2
+        cos2Sigma = (cosSigma - 2 * sinU0 * sinU1 / cosAlpha2) if cosAlpha2 else 0. # Equator
+        C = f / 16 * cosAlpha2 * (4 + f * (4 - 3 * cosAlpha2))
+        prev = lam
+        lam = L + (1 - C) * f * sinAlpha * (sigma + C * sinSigma
+                * (cos2Sigma + C * cosSigma * (-1 + 2 * cos2Sigma**2)))
+        if abs(lam - prev) < criteria: break
+    else:
+        return math.nan
+    u2 = cosAlpha2 * (a**2 - b**2) / b**2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    dSigma = B * sinSigma * (cos2Sigma + B / 4 * (cosSigma * (-1 + 2 * cos2Sigma**2)
+            - B / 6 * cos2Sigma * (-3 + 4 * sinSigma**2) * (-3 + 4 * cos2Sigma**2)))
+    return b * A * (sigma - dSigma)
+
+def reference(pairs:tuple) -> tuple:
+    ''' (name, float64 meters) for pairs, from a solver which does not use greatCircle '''
+    pairs = [x.astype(float) for x in pairs] # Exactly the values greatCircle gets
+    try:
+        from geographiclib.geodesic import Geodesic # Optional, accurate to nanometers everywhere
+        inverse = lambda lon0, lat0, lon1, lat1: Geodesic.WGS84.Inverse(
+                lat0, lon0, lat1, lon1, Geodesic.DISTANCE)["s12"]
+        name = "geographiclib"
+    except ImportError:
+        inverse = vincenty
+        name = "vincenty"
+    return (name, np.array([inverse(*x) for x in zip(*pairs)]))
+
+def timeIt(func, minTime:float) -> tuple:
+    ''' Call func repeatedly for at least minTime seconds, return (best seconds, calls) '''
+    best = np.inf
+    cnt = 0
+    tStart = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+        cnt += 1
+        if (time.perf_counter() - tStart) >= minTime: break
+    return (best, cnt)
+
+def peakMemory(func) -> int:
+    ''' Peak bytes allocated while calling func, numpy reports to tracemalloc '''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark(pairs:tuple, reference:np.array, units:Units, method:Method,
+              args:ArgumentParser, source:str) -> dict:
+    ''' Benchmark one configuration, computed in the inputs' dtype, errors are in meters '''
+    (lon0, lat0, lon1, lat1) = pairs
+    n = lon0.size
+    options = dict(units=units, method=method, chunkSize=args.chunkSize, workers=args.workers,
+                   dtype=lon0.dtype)
+    func = lambda: greatCircle(lon0, lat0, lon1, lat1, **options)
+    (dt, cnt) = timeIt(func, args.minTime)
+    info = dict(
+            source=source,
+            n=n,
+            dtype=str(lon0.dtype),
+            units=units.name,
+            method=method.value,
+            chunkSize=args.chunkSize,
+            workers=args.workers,
+            seconds=dt,
+            calls=cnt,
+            pairsPerSecond=n / dt if dt > 0 else None,
+            peakBytes=peakMemory(func) if args.memory else None,
+            )
+    if reference is not None:
+        delta = np.abs(func() / units - reference)
+        info["maxError"] = float(np.nanmax(delta)) if n else 0.
+        info["rmsError"] = float(np.sqrt(np.nanmean(delta**2))) if n else 0.
+        q = reference <= closedFormLimit # Where methodErrors bounds the closed forms
+        info["maxErrorInLimit"] = float(np.nanmax(delta[q])) if q.any() else 0.
+    return info
+
+def environment() -> dict:
+    return dict(
+            python=platform.python_version(),
+            numpy=np.__version__,
+            machine=platform.machine(),
+            node=platform.node(),
+            time=time.time(),
+            )
+
+def compare(results:list, fn:str, speedTolerance:float, errorTolerance:float) -> int:
+    '''
+    Compare results against the baseline in fn, matching on everything but the measurements.
+    Returns the number of regressions, a throughput drop of more than speedTolerance,
+    a fraction, or a maximum error which grows by more than errorTolerance meters.
+    '''
+    measurements = ("seconds", "calls", "pairsPerSecond", "peakBytes",
+                    "maxError", "rmsError", "maxErrorInLimit")
+    mkKey = lambda x: tuple((k, x[k]) for k in sorted(x) if k not in measurements)
+    baseline = {}
+    with open(fn, "r") as fp:
+        for line in fp:
+            item = json.loads(line)
+            if "environment" not in item: baseline[mkKey(item)] = item
+
+    nBad = 0
+    for item in results:
+        base = baseline.get(mkKey(item))
+        if base is None: continue
+        if base.get("pairsPerSecond") and item["pairsPerSecond"] is not None \
+                and item["pairsPerSecond"] < (1 - speedTolerance) * base["pairsPerSecond"]:
+            logging.error("Slower, %s pairs/sec versus %s, %s",
+                          item["pairsPerSecond"], base["pairsPerSecond"], mkKey(item))
+            nBad += 1
+        if "maxError" in item and "maxError" in base \
+                and item["maxError"] > base["maxError"] + errorTolerance:
+            logging.error("Less accurate, %s m versus %s, %s",
+                          item["maxError"], base["maxError"], mkKey(item))
+            nBad += 1
+    return nBad
+
+if __name__ == "__main__":
+    import Logger
+
+    parser = ArgumentParser()
+    Logger.addArgs(parser)
+    parser.add_argument("--nc", type=str, help="distance.sample.nc to measure errors against")
+    parser.add_argument("--size", type=int, action="append",
+                        help="Number of synthetic pairs, may be repeated")
+    parser.add_argument("--dtype", type=str, action="append", choices=("float32", "float64"),
+                        help="Input and computation dtype, may be repeated")
+    parser.add_argument("--units", type=str, action="append", choices=Units.__members__,
+                        help="Output units, may be repeated")
+    parser.add_argument("--method", type=str, action="append",
+                        choices=[m.value for m in Method if m != Method.Auto],
+                        help="Distance method, may be repeated")
+    parser.add_argument("--chunkSize", type=int, help="greatCircle's chunkSize")
+    parser.add_argument("--workers", type=int, help="greatCircle's workers")
+    parser.add_argument("--seed", type=int, default=12345, help="Random number seed")
+    parser.add_argument("--minTime", type=float, default=1,
+                        help="Minimum seconds to spend timing each configuration")
+    parser.add_argument("--noMemory", action="store_false", dest="memory",
+                        help="Do not measure peak memory, which slows the call down")
+    parser.add_argument("--output", type=str, help="JSON lines file to write results to")
+    parser.add_argument("--baseline", type=str, help="JSON lines results to compare against")
+    parser.add_argument("--speedTolerance", type=float, default=0.2,
+                        help="Fractional throughput drop treated as a regression")
+    parser.add_argument("--errorTolerance", type=float, default=1e-6,
+                        help="Increase in maximum error, meters, treated as a regression")
+    args = parser.parse_args()
+
+    Logger.mkLogger(args, fmt="%(asctime)s %(levelname)s: %(message)s")
+
+    sizes = args.size if args.size else [1, 100, 10000, 1000000]
+    dtypes = args.dtype if args.dtype else ["float64"]
+    units = [Units[u] for u in args.units] if args.units else [Units.Meters]
+    methods = [Method(m) for m in args.method] if args.method else [Method.Vincenty]
+
+    results = []
+    for dtype in dtypes:
+        samples = []
+        for n in sizes:
+            pairs = mkSample(n, args.seed, dtype)
+            (name, dist) = reference(pairs)
+            samples.append((f"synthetic {n} versus {name}", pairs, dist))
+        if args.nc:
+            (lon0, lat0, lon1, lat1, dist) = loadSample(args.nc)
+            samples.append((args.nc, tuple(x.astype(dtype) for x in (lon0, lat0, lon1, lat1)),
+                            dist))
+        for (source, pairs, dist) in samples:
+            for unit in units:
+                for method in methods:
+                    info = benchmark(pairs, dist, unit, method, args, source)
+                    logging.info("%s", info)
+                    results.append(info)
+
+    fp = open(args.output, "w") if args.output else sys.stdout
+    try:
+        fp.write(json.dumps(dict(environment=environment())) + "\n")
+        for info in results: fp.write(json.dumps(info) + "\n")
+    finally:
+        if fp is not sys.stdout: fp.close()
+
+    if args.baseline and compare(results, args.baseline,
+                                 args.speedTolerance, args.errorTolerance):
+        sys.exit(1)
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+#
+# Benchmark the cold start import time of this package and each of its modules
+#
+# Each import is run in a fresh interpreter with -X importtime, from the directory above
+# the package, so the numbers are what a script started by a systemd timer pays. The
+# heavy third party or slow standard modules each import loads are recorded, and an import
+# which loads one it is not expected to is a regression, as is one which got slower than
+# --baseline's. Results are written as JSON lines.
+
+from argparse import ArgumentParser
+import subprocess
+import platform
+import logging
+import json
+import time
+import sys
+import os
+
+# Modules which are slow to import, and the package modules allowed to import them
+heavy = ("numpy", "pandas", "xarray", "dask", "yaml", "pyinotify", "psycopg",
+         "smtplib", "email.message", "cProfile", "pstats", "concurrent.futures",
+         "multiprocessing", "asyncio")
+allowed = {
+        "AsyncINotify": ("pyinotify", "asyncio", "concurrent.futures"),
+        "Dispatcher": ("concurrent.futures",),
+        "GreatCircle": ("numpy",),
+        "INotify": ("pyinotify",),
+        "SpatialIndex": ("numpy",),
+        }
+modules = ("", "Logger", "Metrics", "Profiler", "Thread", "SingleInstance", "Credentials",
+           "loadAndExecuteSQL", "Dispatcher", "INotify", "AsyncINotify", "GreatCircle",
+           "SpatialIndex")
+
+def importTime(package:str, module:str, cwd:str) -> tuple:
+    '''
+    Import package.module in a fresh interpreter, return
+    (wall seconds for the interpreter, import seconds, {module: seconds} of what it loaded)
+    '''
+    target = package + ("." + module if module else "")
+    t0 = time.perf_counter()
+    proc = subprocess.run((sys.executable, "-X", "importtime", "-c", "import " + target),
+                          cwd=cwd, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if proc.returncode:
+        raise RuntimeError(f"Unable to import {target}, {proc.stderr.strip()}")
+    loaded = {}
+    for line in proc.stderr.splitlines(): # import time: self [us] | cumulative | name
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit(): continue
+        loaded[fields[2].strip()] = int(fields[1]) * 1e-6
+    return (wall, loaded.get(target), loaded)
+
+def benchmark(package:str, module:str, cwd:str, repeat:int) -> dict:
+    ''' Best of repeat imports of package.module '''
+    best = None
+    for i in range(repeat):
+        (wall, dt, loaded) = importTime(package, module, cwd)
+        if best is None or dt < best[1]: best = (wall, dt, loaded)
+    (wall, dt, loaded) = best
+    found = [name for name in heavy if name in loaded]
+    return dict(
+            module=module or package,
+            seconds=dt,
+            wallSeconds=wall,
+            modulesLoaded=len(loaded),
+            heavy=found,
+            unexpected=[name for name in found if name not in allowed.get(module, ())],
+            )
+
+def environment() -> dict:
+    return dict(
+            python=platform.python_version(),
+            machine=platform.machine(),
+            node=platform.node(),
+            time=time.time(),
+            )
+
+def compare(results:list, fn:str, tolerance:float, slack:float) -> int:
+    '''
+    Compare results against the baseline in fn, returns the number of imports which
+    got slower by more than the fraction tolerance plus slack seconds
+    '''
+    baseline = {}
+    with open(fn, "r") as fp:
+        for line in fp:
+            item = json.loads(line)
+            if "environment" not in item: baseline[item["module"]] = item
+
+    nBad = 0
+    for item in results:
+        base = baseline.get(item["module"])
+        if base is None: continue
+        if item["seconds"] > (1 + tolerance) * base["seconds"] + slack:
+            logging.error("Slower import of %s, %s seconds versus %s",
+                          item["module"], item["seconds"], base["seconds"])
+            nBad += 1
+    return nBad
+
+if __name__ == "__main__":
+    import Logger
+
+    parser = ArgumentParser()
+    Logger.addArgs(parser)
+    parser.add_argument("--module", type=str, action="append", choices=modules[1:],
+                        help="Module to time, may be repeated, by default all of them")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Imports of each module, the fastest is reported")
+    parser.add_argument("--output", type=str, help="JSON lines file to write results to")
+    parser.add_argument("--baseline", type=str, help="JSON lines results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Fractional slow down treated as a regression")
+    parser.add_argument("--slack", type=float, default=0.005,
+                        help="Seconds of slow down always allowed, for timer noise")
+    parser.add_argument("--maxSeconds", type=float,
+                        help="Import time of any module treated as a regression")
+    args = parser.parse_args()
+
+    Logger.mkLogger(args, fmt="%(asctime)s %(levelname)s: %(message)s")
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    (cwd, package) = os.path.split(directory)
+
+    results = []
+    for module in ([""] + args.module if args.module else modules):
+        info = benchmark(package, module, cwd, args.repeat)
+        logging.info("%s", info)
+        results.append(info)
+
+    fp = open(args.output, "w") if args.output else sys.stdout
+    try:
+        fp.write(json.dumps(dict(environment=environment())) + "\n")
+        for info in results: fp.write(json.dumps(info) + "\n")
+    finally:
+        if fp is not sys.stdout: fp.close()
+
+    nBad = 0
+    for info in results:
+        if info["unexpected"]:
+            logging.error("Importing %s loads %s", info["module"], ", ".join(info["unexpected"]))
+            nBad += 1
+        if args.maxSeconds is not None and info["seconds"] > args.maxSeconds:
+            logging.error("Importing %s takes %s seconds", info["module"], info["seconds"])
+            nBad += 1
+    if args.baseline: nBad += compare(results, args.baseline, args.tolerance, args.slack)
+    if nBad: sys.exit(1)
@@ -5,9 +5,24 @@
 # This has been tested with PostgreSQL 14 and psycopg 3, 
 # but it should work with most databases
 #
+# loadAndExecuteDirectory runs the new or changed SQL files in a directory, recording
+# each file's content hash in a ledger table so unchanged files are skipped. The files
+# run in dependency order, given by "-- depends: other.sql" comments, in one transaction.
+# It also works with sqlite3, which is handy for testing.
+#
+# streamAndExecuteSQL reads the file a statement at a time, executing them in batches,
+# each in a savepoint, and sends COPY ... FROM STDIN data through psycopg's copy, so
+# files of any size can be loaded, with the line of any failing statement reported.
+#
 # April-2023, Pat Welch, pat@mousebrains.com
 
 import logging
+import hashlib
+import fnmatch
+import time
+import sys
+import re
+import os
 
 def loadAndExecuteSQL(db, fn:str, tableName:str=None) -> bool:
     body = None
@@ -34,19 +49,393 @@ def loadAndExecuteSQL(db, fn:str, tableName:str=None) -> bool:
         db.rollback()
         return False
 
+def _placeholder(db) -> str:
+    ''' The parameter placeholder of db's driver, %s for psycopg and ? for sqlite3 '''
+    module = sys.modules.get(type(db).__module__.split(".")[0])
+    return "?" if getattr(module, "paramstyle", "pyformat") == "qmark" else "%s"
+
+def _begin(db, cur) -> None:
+    ''' Start a transaction, unless sqlite3 says one is in progress '''
+    if not getattr(db, "in_transaction", False): cur.execute("BEGIN TRANSACTION;")
+
+def _executeBody(db, cur, body:str) -> None:
+    ''' Execute body, which may hold several statements '''
+    if type(db).__module__ != "sqlite3":
+        cur.execute(body)
+        return
+    # sqlite3 executes one statement at a time, and executescript commits first,
+    # so split body where SQLite says a statement is complete
+    import sqlite3
+    statement = ""
+    for piece in body.split(";"):
+        statement += piece + ";"
+        if sqlite3.complete_statement(statement):
+            cur.execute(statement)
+            statement = ""
+
+def dependencyOrder(files:dict) -> list:
+    '''
+    files is {name: [names it depends on]}, return the names with each after the ones it
+    depends on, otherwise in name order. Raises ValueError for unknown names or cycles.
+    '''
+    for (name, depends) in files.items():
+        for item in depends:
+            if item not in files: raise ValueError(f"{name} depends on {item}, which is unknown")
+    order = []
+    done = set()
+    while len(order) < len(files):
+        ready = [name for name in sorted(files)
+                 if name not in done and all(item in done for item in files[name])]
+        if not ready:
+            raise ValueError("Circular dependencies between " + ", ".join(sorted(set(files) - done)))
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+def loadAndExecuteDirectory(db, directory:str, ledger:str="sqlLedger",
+                            pattern:str="*.sql", qForce:bool=False) -> bool:
+    '''
+    Execute the files matching pattern in directory which are not in the ledger table with
+    the same content hash, in dependency order, then record them in the ledger. This is
+    all one transaction, so either every new or changed file is applied or none are.
+    A file lists what it depends on in comments, "-- depends: a.sql, b.sql". Changed
+    files are run again, so they should be safe to rerun, e.g. CREATE ... IF NOT EXISTS.
+    qForce runs every file, whether or not it has changed.
+    '''
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", ledger):
+        raise ValueError(f"Invalid ledger table name {ledger}")
+    p = _placeholder(db)
+    files = {} # name -> (hash, body, depends)
+    try:
+        for name in sorted(os.listdir(directory)):
+            fn = os.path.join(directory, name)
+            if not fnmatch.fnmatch(name, pattern) or not os.path.isfile(fn): continue
+            with open(fn, "rb") as fp: content = fp.read()
+            body = content.decode("utf-8")
+            depends = []
+            for line in re.findall(r"^\s*--\s*depends:(.*)$", body, re.MULTILINE | re.IGNORECASE):
+                depends.extend(item for item in re.split(r"[\s,]+", line) if item)
+            files[name] = (hashlib.sha256(content).hexdigest(), body, depends)
+        order = dependencyOrder({name: files[name][2] for name in files})
+    except Exception:
+        logging.exception("Unable to load the SQL files in %s", directory)
+        return False
+
+    name = None
+    try:
+        cur = db.cursor()
+        _begin(db, cur)
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {ledger} ("
+                    + "filename TEXT PRIMARY KEY,"
+                    + " hash TEXT NOT NULL,"
+                    + " seconds DOUBLE PRECISION,"
+                    + " applied TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);")
+        cur.execute(f"SELECT filename, hash FROM {ledger};")
+        applied = dict(cur.fetchall())
+
+        tStart = time.time()
+        cnt = 0
+        for name in order:
+            (digest, body, depends) = files[name]
+            if not qForce and applied.get(name) == digest:
+                logging.debug("Skipping %s, unchanged", name)
+                continue
+            t0 = time.time()
+            _executeBody(db, cur, body)
+            dt = time.time() - t0
+            cur.execute(f"DELETE FROM {ledger} WHERE filename={p};", (name,))
+            cur.execute(f"INSERT INTO {ledger} (filename, hash, seconds) VALUES({p},{p},{p});",
+                        (name, digest, dt))
+            logging.info("Executed %s, %s bytes, %s, in %.3f seconds",
+                         name, len(body), "changed" if name in applied else "new", dt)
+            cnt += 1
+        db.commit()
+        logging.info("Executed %s of %s files in %s in %.3f seconds",
+                     cnt, len(order), directory, time.time() - tStart)
+        return True
+    except:
+        logging.exception("Unable to execute %s in %s, nothing was applied", name, directory)
+        db.rollback()
+        return False
+
+class SQLReader:
+    '''
+    Split a file of PostgreSQL statements as it is read, so memory is bounded by the
+    longest statement rather than the file. Semicolons inside string literals, E'' strings,
+    quoted identifiers, dollar quoted bodies, and -- or nested /* */ comments do not end
+    a statement. The data lines following a COPY ... FROM STDIN, up to \\., are not parsed.
+    '''
+    __normal = re.compile(r"""[;'"$]|--|/\*""")
+    __dollarTag = re.compile(r"\$(?:[^\W\d]\w*)?\$")
+    __comment = re.compile(r"/\*|\*/")
+    __escaped = re.compile(r"[\\']")
+    __copy = re.compile(r"(?:\s|--[^\n]*\n|/\*.*?\*/)*COPY\b.*\bFROM\s+STDIN\b", re.I | re.S)
+    __names = {"'": "a string", "E": "an E'' string", '"': "a quoted identifier",
+               "/*": "a comment"}
+
+    def __init__(self, fp) -> None:
+        self.__lines = iter(fp)
+        self.lineNo = 0 # Lines read so far
+        self.nChars = 0 # Characters read so far
+
+    def __readLine(self) -> str:
+        line = next(self.__lines, None)
+        if line is not None:
+            self.lineNo += 1
+            self.nChars += len(line)
+        return line
+
+    def __copyData(self):
+        ''' The COPY data lines, up to but not including the terminating \\. line '''
+        while True:
+            line = self.__readLine()
+            if line is None: raise ValueError(f"COPY data is not ended by \\. at line {self.lineNo}")
+            if line.rstrip("\r\n") == "\\.": return
+            yield line
+
+    @staticmethod
+    def __qIdentifier(line:str, k:int) -> bool:
+        ''' Is the character before k part of an identifier '''
+        return k > 0 and (line[k-1].isalnum() or line[k-1] == "_")
+
+    def statements(self):
+        '''
+        Generate (line, statement, copy) for each statement, where line is the line it starts
+        on and copy is None or, for COPY ... FROM STDIN, an iterator over the data lines.
+        Statements with only comments are skipped. Raises ValueError if the file ends inside
+        a quote or comment.
+        '''
+        parts = []
+        start = None # Line the statement starts on, None until there is more than comments
+        state = None # None, "'", "E", '"', "/*", or the dollar quote's tag
+        depth = 0 # Of nested /* */ comments
+        stateLine = None # Where the quote or comment started
+        while True:
+            line = self.__readLine()
+            if line is None: break
+            (i, n) = (0, len(line))
+            while i < n:
+                if state is None:
+                    m = self.__normal.search(line, i)
+                    k = n if m is None else m.start()
+                    if start is None and line[i:k].strip(): start = self.lineNo
+                    if m is None or m.group() == "--": # Rest of the line
+                        parts.append(line[i:])
+                        break
+                    token = m.group()
+                    j = m.end()
+                    if token == ";":
+                        parts.append(line[i:j])
+                        i = j
+                        if start is not None:
+                            statement = "".join(parts).strip()
+                            copy = self.__copyData() if self.__copy.match(statement) else None
+                            yield (start, statement, copy)
+                            if copy is not None:
+                                for item in copy: pass # Skip what the caller did not read
+                        parts = []
+                        start = None
+                        continue
+                    if token == "$":
+                        mt = self.__dollarTag.match(line, k)
+                        if mt is None or self.__qIdentifier(line, k): # $1 or foo$bar
+                            if start is None: start = self.lineNo
+                            parts.append(line[i:j])
+                            i = j
+                            continue
+                        j = mt.end()
+                        state = mt.group()
+                    elif token == "/*":
+                        state = "/*"
+                        depth = 1
+                    elif token == "'":
+                        qE = k > 0 and line[k-1] in "eE" and not self.__qIdentifier(line, k - 1)
+                        state = "E" if qE else "'"
+                    else:
+                        state = '"'
+                    if state != "/*" and start is None: start = self.lineNo
+                    stateLine = self.lineNo
+                    parts.append(line[i:j])
+                    i = j
+                    continue
+                if state == "/*":
+                    m = self.__comment.search(line, i)
+                    if m is None: break
+                    depth += 1 if m.group() == "/*" else -1
+                    if depth == 0: state = None
+                    j = m.end()
+                elif state == "E":
+                    m = self.__escaped.search(line, i)
+                    if m is None: break
+                    k = m.start()
+                    if m.group() == "\\" or line[k+1:k+2] == "'": # Escaped or doubled
+                        j = k + 2
+                    else:
+                        j = k + 1
+                        state = None
+                elif state in ("'", '"'):
+                    k = line.find(state, i)
+                    if k < 0: break
+                    if line[k+1:k+2] == state: # Doubled
+                        j = k + 2
+                    else:
+                        j = k + 1
+                        state = None
+                else: # Dollar quoted
+                    k = line.find(state, i)
+                    if k < 0: break
+                    j = k + len(state)
+                    state = None
+                parts.append(line[i:j])
+                i = j
+            if i < n and state is not None: parts.append(line[i:]) # Quote or comment continues
+
+        if state is not None:
+            what = self.__names.get(state, "a dollar quote " + state)
+            raise ValueError(f"The file ends inside {what} started on line {stateLine}")
+        if start is not None: yield (start, "".join(parts).strip(), None)
+
+def _executeBatch(db, cur, batch:list, qSkipErrors:bool) -> int:
+    '''
+    Execute batch, a list of (line, statement), in a savepoint. psycopg gets the whole
+    batch in one round trip. If it fails, the statements are run one at a time to find
+    the failing ones, which are skipped with qSkipErrors, otherwise raised.
+    Returns the number of statements which failed.
+    '''
+    if not batch: return 0
+    cur.execute("SAVEPOINT batch;")
+    try:
+        if type(db).__module__ != "sqlite3": # Several statements per execute
+            cur.execute("\n".join(item[1] for item in batch))
+        else:
+            for item in batch: cur.execute(item[1])
+        cur.execute("RELEASE SAVEPOINT batch;")
+        return 0
+    except Exception:
+        cur.execute("ROLLBACK TO SAVEPOINT batch;")
+
+    nBad = 0
+    for (line, statement) in batch:
+        cur.execute("SAVEPOINT statement;")
+        try:
+            cur.execute(statement)
+            cur.execute("RELEASE SAVEPOINT statement;")
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT statement;")
+            logging.error("Statement at line %s failed, %s\n%s", line, e, statement[:1000])
+            if not qSkipErrors: raise
+            nBad += 1
+    cur.execute("RELEASE SAVEPOINT batch;")
+    return nBad
+
+def _executeCopy(cur, line:int, statement:str, data, qSkipErrors:bool) -> int:
+    ''' Send the data lines of a COPY ... FROM STDIN, returns 1 if it failed '''
+    cur.execute("SAVEPOINT batch;")
+    try:
+        if not hasattr(cur, "copy"): raise RuntimeError("COPY FROM STDIN needs psycopg")
+        with cur.copy(statement.rstrip(";")) as copy:
+            buffer = []
+            size = 0
+            for row in data:
+                buffer.append(row)
+                size += len(row)
+                if size >= 1048576: # Write about a MB at a time
+                    copy.write("".join(buffer))
+                    buffer = []
+                    size = 0
+            if buffer: copy.write("".join(buffer))
+        cur.execute("RELEASE SAVEPOINT batch;")
+        return 0
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT batch;")
+        logging.error("COPY at line %s failed, %s\n%s", line, e, statement[:1000])
+        if not qSkipErrors: raise
+        return 1
+
+def streamAndExecuteSQL(db, fn:str, batchSize:int=1000, qSkipErrors:bool=False,
+                        progressInterval:float=10) -> bool:
+    '''
+    Execute the SQL file fn a statement at a time as it is read, with SQLReader, in one
+    transaction. Every batchSize statements are executed together in a savepoint, and
+    COPY ... FROM STDIN data is streamed through psycopg's copy. A failing statement is
+    logged with its line number. Then, with qSkipErrors, only it is rolled back and the
+    rest continue; otherwise everything is rolled back.
+    Progress is logged every progressInterval seconds.
+    '''
+    tStart = time.time()
+    tNext = tStart + progressInterval
+    (nStatements, nCopies, nBad) = (0, 0, 0)
+    try:
+        cur = db.cursor()
+        _begin(db, cur)
+        with open(fn, "r") as fp:
+            reader = SQLReader(fp)
+            batch = []
+            for (line, statement, copy) in reader.statements():
+                if copy is not None:
+                    nBad += _executeBatch(db, cur, batch, qSkipErrors)
+                    batch = []
+                    nBad += _executeCopy(cur, line, statement, copy, qSkipErrors)
+                    nCopies += 1
+                else:
+                    batch.append((line, statement))
+                    if len(batch) >= batchSize:
+                        nBad += _executeBatch(db, cur, batch, qSkipErrors)
+                        batch = []
+                nStatements += 1
+                if time.time() >= tNext:
+                    logging.info("%s line %s, %s statements, %.1f MB",
+                                 fn, reader.lineNo, nStatements, reader.nChars / 1048576)
+                    tNext = time.time() + progressInterval
+            nBad += _executeBatch(db, cur, batch, qSkipErrors)
+        db.commit()
+        logging.info("Executed %s statements, %s COPYs, %s failed, from %s in %.3f seconds",
+                     nStatements, nCopies, nBad, fn, time.time() - tStart)
+        return True
+    except:
+        logging.exception("Unable to execute %s, nothing was applied", fn)
+        db.rollback()
+        return False
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     import Logger
-    import psycopg
 
     parser = ArgumentParser()
     Logger.addArgs(parser)
     parser.add_argument("db", type=str, help="Database name")
-    parser.add_argument("sql", type=str, help="File containing SQL statements")
+    parser.add_argument("sql", type=str,
+                        help="File containing SQL statements, or a directory of them")
+    parser.add_argument("--ledger", type=str, default="sqlLedger",
+                        help="Table recording the files executed from a directory")
+    parser.add_argument("--pattern", type=str, default="*.sql",
+                        help="Which files in a directory to execute")
+    parser.add_argument("--force", action="store_true",
+                        help="Execute every file in the directory, even if unchanged")
+    parser.add_argument("--sqlite", action="store_true", help="db is an SQLite file")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read and execute the file a statement at a time")
+    parser.add_argument("--batchSize", type=int, default=1000,
+                        help="Statements per batch when streaming")
+    parser.add_argument("--skipErrors", action="store_true",
+                        help="When streaming, skip failing statements instead of rolling back")
     args = parser.parse_args()
 
 
     Logger.mkLogger(args, fmt="%(asctime)s %(levelname)s: %(message)s")
 
-    with psycopg.connect(f"dbname={args.db}") as db:
-        loadAndExecuteSQL(db, args.sql)
+    if args.sqlite:
+        import sqlite3
+        db = sqlite3.connect(args.db)
+    else:
+        import psycopg
+        db = psycopg.connect(f"dbname={args.db}")
+
+    with db:
+        if os.path.isdir(args.sql):
+            qOkay = loadAndExecuteDirectory(db, args.sql, args.ledger, args.pattern, args.force)
+        elif args.stream:
+            qOkay = streamAndExecuteSQL(db, args.sql, args.batchSize, args.skipErrors)
+        else:
+            qOkay = loadAndExecuteSQL(db, args.sql)
+    sys.exit(0 if qOkay else 1)